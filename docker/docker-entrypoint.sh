@@ -4,8 +4,11 @@ ONTO_REPO=${ONTO_REPO:-"https://mydefault-onto-repo-url"}
 ONTO_GIT_TAG=${ONTO_GIT_TAG:-"v1.0"}
 ONTO_REPO_USERNAME=${ONTO_REPO_USERNAME:-""}
 ONTO_REPO_PASSWORD=${ONTO_REPO_PASSWORD:-""}
+ONTO_CHECKSUMS=${ONTO_CHECKSUMS:-""}
 ONTOLOGY_DIR=${ONTOLOGY_DIR:-"/default/ontology/dir"}
 UPDATE_ONTOLOGY=${UPDATE_ONTOLOGY:-"false"}
+READ_ONTOLOGY_FROM_ZIP=${READ_ONTOLOGY_FROM_ZIP:-"false"}
+ONTOLOGY_WORKERS=${ONTOLOGY_WORKERS:-"1"}
 AVAILABILITY_MASTER_IDENT=${AVAILABILITY_MASTER_IDENT:-"fdpg-data-availability-report-obfuscated"}
 AVAILABILITY_INPUT_DIR=${AVAILABILITY_INPUT_DIR:-"/default/input/dir"}
 AVAILABILITY_OUTPUT_DIR=${AVAILABILITY_OUTPUT_DIR:-"/default/output/dir"}
@@ -13,6 +16,17 @@ AVAILABILITY_REPORT_SERVER_BASE_URL=${AVAILABILITY_REPORT_SERVER_BASE_URL:-"http
 ES_BASE_URL=${ES_BASE_URL:-"https://elasticsearch-url"}
 ES_INDEX=${ES_INDEX:-"default-index"}
 MIN_N_REPORTS=${MIN_N_REPORTS:-"3"}
+REPORT_FETCH_CONCURRENCY=${REPORT_FETCH_CONCURRENCY:-"4"}
+REPORT_WORKERS=${REPORT_WORKERS:-"1"}
+FULL_REFRESH=${FULL_REFRESH:-"false"}
+STREAM_ES_UPDATES=${STREAM_ES_UPDATES:-"false"}
+ES_BULK_GZIP=${ES_BULK_GZIP:-"false"}
+SKIP_ZERO_BUCKETS=${SKIP_ZERO_BUCKETS:-"false"}
+ES_UPDATE_MODE=${ES_UPDATE_MODE:-"update"}
+METRICS_TEXTFILE=${METRICS_TEXTFILE:-""}
+PROFILE=${PROFILE:-""}
+PROFILE_SAMPLE_RATE=${PROFILE_SAMPLE_RATE:-"1.0"}
+USE_NUMPY=${USE_NUMPY:-"true"}
 LOGLEVEL=${LOGLEVEL:-INFO}
 
 # Enable oauth
@@ -55,6 +69,11 @@ if [ "$USE_BASIC_AUTH" = "true" ]; then
   AUTH_ARGS+=(--basic-password "$BASIC_PASSWORD")
 fi
 
+ONTO_ARGS=()
+if [ -n "$ONTO_CHECKSUMS" ]; then
+  ONTO_ARGS+=(--onto-checksums "$ONTO_CHECKSUMS")
+fi
+
 
 CA_CERT="/opt/availability-updater/auth/cert.pem"
 # Optional own ca cert
@@ -66,18 +85,63 @@ if [ "$UPDATE_ONTOLOGY" = "true" ]; then
   UPDATE_ONTO="--update-ontology" 
 fi
 
+if [ "$READ_ONTOLOGY_FROM_ZIP" = "true" ]; then
+  READ_ONTOLOGY_FROM_ZIP_ARG="--read-ontology-from-zip"
+fi
+
+if [ "$FULL_REFRESH" = "true" ]; then
+  FULL_REFRESH_ARG="--full-refresh"
+fi
+
+if [ "$STREAM_ES_UPDATES" = "true" ]; then
+  STREAM_ES_UPDATES_ARG="--stream-es-updates"
+fi
+
+if [ "$ES_BULK_GZIP" = "true" ]; then
+  ES_BULK_GZIP_ARG="--es-bulk-gzip"
+fi
+
+if [ "$SKIP_ZERO_BUCKETS" = "true" ]; then
+  SKIP_ZERO_BUCKETS_ARG="--skip-zero-buckets"
+fi
+
+METRICS_ARGS=()
+if [ -n "$METRICS_TEXTFILE" ]; then
+  METRICS_ARGS+=(--metrics-textfile "$METRICS_TEXTFILE")
+fi
+
+if [ -n "$PROFILE" ]; then
+  METRICS_ARGS+=(--profile "$PROFILE" --profile-sample-rate "$PROFILE_SAMPLE_RATE")
+fi
+
+if [ "$USE_NUMPY" = "true" ]; then
+  USE_NUMPY_ARG="--use-numpy"
+fi
+
 
 python src/py/generate_availability.py \
   --onto-repo "$ONTO_REPO" \
   --onto-git-tag "$ONTO_GIT_TAG" \
   --ontology-dir "$ONTOLOGY_DIR" \
+  --ontology-workers "$ONTOLOGY_WORKERS" \
   $UPDATE_ONTO \
+  "${ONTO_ARGS[@]}" \
+  $READ_ONTOLOGY_FROM_ZIP_ARG \
+  $FULL_REFRESH_ARG \
+  $STREAM_ES_UPDATES_ARG \
+  $ES_BULK_GZIP_ARG \
+  $SKIP_ZERO_BUCKETS_ARG \
+  $USE_NUMPY_ARG \
   --availability-master-ident "$AVAILABILITY_MASTER_IDENT" \
   --availability-input-dir "$AVAILABILITY_INPUT_DIR" \
   --availability-output-dir "$AVAILABILITY_OUTPUT_DIR" \
   --availability-report-server-base-url "$AVAILABILITY_REPORT_SERVER_BASE_URL" \
   --es-base-url "$ES_BASE_URL" \
   --es-index "$ES_INDEX" \
+  --es-update-mode "$ES_UPDATE_MODE" \
   --min-n-reports "$MIN_N_REPORTS" \
+  --report-fetch-concurrency "$REPORT_FETCH_CONCURRENCY" \
+  --report-workers "$REPORT_WORKERS" \
   --loglevel "$LOGLEVEL" \
+  "${METRICS_ARGS[@]}" \
   "${AUTH_ARGS[@]}"
@@ -1,9 +1,35 @@
+import gzip
+import hashlib
+import io
 import json
 import logging
-import sys
+import re
 import uuid
-from pathlib import Path
-from typing import Dict, Any, Iterable, List, Optional
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import groupby
+from fnmatch import fnmatch
+from pathlib import Path, PurePosixPath
+from array import array
+from bisect import bisect_right
+from typing import Dict, Any, BinaryIO, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:  # optional, see use_numpy
+    np = None
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:  # optional, see stream_reports
+    ijson = None
+
+from atomic_file import atomic_write
+from json_backend import STDLIB, JsonBackend, get_backend
+from ontology_graph import OntologyGraph
+from run_metrics import RunMetrics
 
 log = logging.getLogger(__name__)
 
@@ -18,183 +44,825 @@ PATIENT_STRAT_TO_TERMCODE: Dict[str, Dict[str, str]] = {
     },
 }
 
+_INDEX_LINE = re.compile(rb"\s*\{\s*\"index\"\s*:")
+_CHILDREN_KEY = re.compile(rb"\"children\"\s*:\s*")
+_JSON_DECODER = json.JSONDecoder()
+# Characters json.dumps(..., ensure_ascii=False) escapes in strings.
+_NEEDS_ESCAPING = re.compile(r'[\x00-\x1f"\\]')
+# Default for termcode keys not looked up in _node_by_termcode yet;
+# None means the key is not in the ontology.
+_NOT_LOOKED_UP = object()
 
-class ElasticAvailabilityGenerator:
+
+def _action_line(action: str, node_id: str) -> bytes:
+    """The bulk action line of node_id, the exact bytes json.dumps(..., ensure_ascii=False) produces."""
+    if _NEEDS_ESCAPING.search(node_id):
+        return json.dumps({action: {"_id": node_id}}, ensure_ascii=False).encode("utf-8") + b"\n"
+    return b'{"' + action.encode("ascii") + b'": {"_id": "' + node_id.encode("utf-8") + b'"}}\n'
+
+
+def _child_hashes(line: bytes) -> List[str]:
     """
-    Generates Elasticsearch partial update files that contain availability buckets
-    derived from availability reports and ontology trees.
+    Child hashes of an ontology document line. Only the `children` array is
+    decoded, the (much larger) rest of the document is skipped. Lines where
+    the first `"children":` is not that array are parsed in full.
+    """
+    match = _CHILDREN_KEY.search(line)
+    if match is None:
+        return []
+    try:
+        children, _ = _JSON_DECODER.raw_decode(line[match.end():].decode("utf-8"))
+        return [child["contextualized_termcode_hash"] for child in children or ()]
+    except (ValueError, TypeError, KeyError):
+        children = json.loads(line).get("children")
+        return [child["contextualized_termcode_hash"] for child in children or ()]
+
+
+def iter_ontology_nodes(lines: Iterable[bytes], backend: JsonBackend = STDLIB) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Yields the node hash and the child hashes of every document in an
+    ontology export, read line by line from `lines` (bulk format: an index
+    line with the `_id`, followed by the document). Unless the backend is
+    faster at parsing whole documents, only their children are decoded.
     """
+    current_id = None
+    for line in lines:
+        if not line.strip():
+            continue
+        if _INDEX_LINE.match(line):
+            current_id = backend.loads(line)["index"]["_id"]
+        elif backend.parse_documents:
+            children = backend.loads(line).get("children")
+            yield current_id, [child["contextualized_termcode_hash"] for child in children or ()]
+        else:
+            yield current_id, _child_hashes(line)
+
+
+def iter_ontology_documents(lines: Iterable[bytes], backend: JsonBackend = STDLIB) -> Iterator[Tuple[str, bytes]]:
+    """Yields the node hash and the (unparsed) document line of every document in an ontology export."""
+    current_id = None
+    for line in lines:
+        if not line.strip():
+            continue
+        if _INDEX_LINE.match(line):
+            current_id = backend.loads(line)["index"]["_id"]
+        else:
+            yield current_id, line
+
+
+_STRATIFIER_PREFIX = "group.item.stratifier.item"
+_STRATIFIER_CODE_PREFIX = _STRATIFIER_PREFIX + ".code.item.coding.item.code"
+_STRATUM_PREFIX = _STRATIFIER_PREFIX + ".stratum.item"
+
+
+def iter_report_strata(fh: BinaryIO) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yields the stratifier code and the stratum of every stratum in a
+    MeasureReport, parsing it incrementally with ijson. Only one stratum is
+    held in memory at a time (plus those of a stratifier whose code comes
+    after its strata, which are kept until the code is known), however large
+    the report is.
+    """
+    events = ijson.parse(fh, use_float=True)
+    strat_code = None
+    pending: List[Dict[str, Any]] = []
+
+    for prefix, event, value in events:
+        if prefix == _STRATUM_PREFIX and event == "start_map":
+            builder = ObjectBuilder()
+            builder.event(event, value)
+            depth = 1
+            for _, event, value in events:
+                builder.event(event, value)
+                if event in ("start_map", "start_array"):
+                    depth += 1
+                elif event in ("end_map", "end_array"):
+                    depth -= 1
+                    if depth == 0:
+                        break
+            if strat_code is None:
+                pending.append(builder.value)
+            else:
+                yield strat_code, builder.value
+
+        elif prefix == _STRATIFIER_CODE_PREFIX and event == "string" and strat_code is None:
+            strat_code = value
+            for stratum in pending:
+                yield strat_code, stratum
+            pending = []
+
+        elif prefix == _STRATIFIER_PREFIX and event == "start_map":
+            strat_code = None
+            pending = []
+
+
+def context_key(context: Dict[str, str]) -> str:
+    return f"{context.get('system')}{context.get('code')}{context.get('version', '')}"
+
+
+def termcode_key(context: Dict[str, str], termcode: Dict[str, str]) -> str:
+    """The string the hash of an ontology node is derived from, see _contextualized_hash."""
+    return f"{context_key(context)}{termcode.get('system')}{termcode.get('code')}"
+
+
+def _stratifier_scores(
+    strat_code: str,
+    strata: Iterable[Dict[str, Any]],
+    stratum_to_context: Dict[str, Dict[str, str]],
+) -> Iterator[Tuple[str, int]]:
+    if strat_code not in stratum_to_context and strat_code not in PATIENT_STRAT_TO_TERMCODE:
+        log.debug("Skipping unknown stratifier %s", strat_code)
+        return
+
+    context = stratum_to_context.get(strat_code)
+
+    if strat_code in PATIENT_STRAT_TO_TERMCODE:
+        termcode = PATIENT_STRAT_TO_TERMCODE[strat_code]
+        score = sum(s["measureScore"]["value"] for s in strata)
+        yield termcode_key(context, termcode), int(score)
+        return
+
+    prefix = context_key(context)
+    for stratum in strata:
+        coding = stratum["value"]["coding"][0]
+
+        if "system" not in coding:
+            continue
+
+        yield f"{prefix}{coding['system']}{coding['code']}", int(stratum["measureScore"]["value"])
+
+
+def iter_report_scores(
+    fh: BinaryIO,
+    stratum_to_context: Dict[str, Dict[str, str]],
+    json_backend: str = "stdlib",
+    stream: bool = False,
+) -> Iterator[Tuple[str, int]]:
+    """
+    Yields the termcode key (see termcode_key) and the score of every
+    stratum of a MeasureReport, patient stratifiers summed up into one.
+    """
+    if stream:
+        for strat_code, items in groupby(iter_report_strata(fh), key=lambda item: item[0]):
+            yield from _stratifier_scores(strat_code, (stratum for _, stratum in items), stratum_to_context)
+        return
 
-    NAMESPACE_UUID = uuid.UUID("00000000-0000-0000-0000-000000000000")
-    FILE_EXTENSION = ".json"
-    MAX_FILESIZE_MB = 10
+    report = get_backend(json_backend).loads(fh.read())
 
-    def __init__(self, availability_input_dir: str, availability_output_dir: str, es_ontology_dir: str) -> None:
-        self.input_dir = Path(availability_input_dir)
-        self.output_dir = Path(availability_output_dir)
-        self.ontology_dir = Path(es_ontology_dir)
+    for group in report.get("group", []):
+        for stratifier in group.get("stratifier", []):
+            if "stratum" not in stratifier:
+                continue
 
-        # Node data is split into two flat dicts instead of one dict-of-dicts:
-        # the ontology export easily runs into the hundreds of thousands of
-        # nodes, and each nested dict plus the unused per-child fields
-        # (display text, terminology, ...) added multiple GB of avoidable
-        # overhead. Only the child hash is ever read, so that's all we keep,
-        # and IDs are interned so a hash shared between a node's key and
-        # another node's children list is stored as a single string object.
-        self.availability: Dict[str, int] = {}
-        self.children: Dict[str, Optional[List[str]]] = {}
+            strat_code = stratifier["code"][0]["coding"][0]["code"]
+            yield from _stratifier_scores(strat_code, stratifier["stratum"], stratum_to_context)
 
-        mapping_file = self.input_dir / "stratum-to-context.json"
-        self.stratum_to_context = json.loads(mapping_file.read_text(encoding="utf-8"))
 
-    def _contextualized_hash(self, context: Dict[str, str], termcode: Dict[str, str]) -> str:
-        """Create stable UUID3 hash for context + termcode combination."""
-        raw = (
-            f"{context.get('system')}{context.get('code')}{context.get('version', '')}"
-            f"{termcode.get('system')}{termcode.get('code')}"
-        )
-        return str(uuid.uuid3(self.NAMESPACE_UUID, raw))
+def _sum_scores(scores: Iterable[Tuple[str, int]]) -> Dict[str, int]:
+    totals: Dict[str, int] = {}
+    for key, score in scores:
+        totals[key] = totals.get(key, 0) + score
+    return totals
 
-    def load_ontology_tree(self) -> None:
-        """Loads ontology export (newline-delimited JSON)."""
-        elastic_dir = self.ontology_dir / "elastic"
-        intern = sys.intern
 
-        for file in elastic_dir.glob("*onto_es__ontology*"):
-            log.info("Loading ontology file %s", file)
+def aggregate_report(
+    file: str,
+    stratum_to_context: Dict[str, Dict[str, str]],
+    json_backend: str = "stdlib",
+    stream: bool = False,
+) -> Dict[str, int]:
+    """Sums up the scores of a MeasureReport file per termcode key. Runs in worker processes."""
+    with open(file, "rb") as fh:
+        return _sum_scores(iter_report_scores(fh, stratum_to_context, json_backend, stream))
 
-            current_id = None
-            for line in file.read_text(encoding="utf-8").splitlines():
-                if not line.strip():
-                    continue
 
-                obj = json.loads(line)
+# An ontology export file, the zip member to read from it (None for an
+# extracted file) and the byte range of the file to parse (end None: to EOF).
+OntologyPart = Tuple[str, Optional[str], int, Optional[int]]
 
-                if "index" in obj:
-                    current_id = intern(obj["index"]["_id"])
-                else:
-                    self.availability[current_id] = 0
-                    children = [intern(child["contextualized_termcode_hash"]) for child in obj.get("children", [])]
-                    self.children[current_id] = children or None
 
-        log.info("Loaded %d ontology nodes", len(self.availability))
+def _iter_range_lines(fh: BinaryIO, size: int) -> Iterator[bytes]:
+    """Yields the lines of the next `size` bytes of fh."""
+    for line in fh:
+        yield line
+        size -= len(line)
+        if size <= 0:
+            return
 
-    def _bucketize(self, value: int) -> int:
-        buckets = (0, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
-        return max(b for b in buckets if value >= b)
 
-    def _accumulate_availability(self, node_id: str, cache: Dict[str, int], in_progress: set = None) -> int:
-        if node_id in cache:
-            return cache[node_id]
+def _iter_part_lines(part: OntologyPart) -> Iterator[bytes]:
+    file, member, start, end = part
+    if member is None:
+        with open(file, "rb") as fh:
+            fh.seek(start)
+            yield from fh if end is None else _iter_range_lines(fh, end - start)
+    else:
+        with zipfile.ZipFile(file) as zf, zf.open(member) as fh:
+            yield from fh
 
-        if in_progress is None:
-            in_progress = set()
 
-        total = self.availability[node_id]
+def split_ontology_file(path: Path, n_parts: int) -> List[Tuple[int, int]]:
+    """
+    Splits an ontology export file into up to n_parts byte ranges of about
+    the same size. Every range starts at an index line, so each document is
+    parsed together with its `_id` by exactly one part.
+    """
+    size = path.stat().st_size
+    starts = [0]
+    with path.open("rb") as fh:
+        for i in range(1, n_parts):
+            position = max(size * i // n_parts, starts[-1] + 1)
+            if position >= size:
+                break
+            # Finish the line the split point falls into, then move on to the
+            # next index line.
+            fh.seek(position - 1)
+            fh.readline()
+            while True:
+                line_start = fh.tell()
+                line = fh.readline()
+                if not line or _INDEX_LINE.match(line):
+                    break
+            if line_start >= size:
+                break
+            if line_start > starts[-1]:
+                starts.append(line_start)
+
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def parse_ontology_part(
+    part: OntologyPart,
+    graph: Optional[OntologyGraph] = None,
+    json_backend: str = "stdlib",
+) -> OntologyGraph:
+    """
+    Adds the nodes of one part of the ontology export to `graph` (a new one
+    if None) and returns it, without finalizing it. Runs in worker processes
+    for parallel loading.
+    """
+    if graph is None:
+        graph = OntologyGraph()
+    backend = get_backend(json_backend)
 
-        in_progress.add(node_id)
-        for child_id in self.children[node_id] or ():
-            if child_id not in self.availability:
-                log.debug("Missing ontology node for child %s of %s", child_id, node_id)
-                continue
-            if child_id in in_progress:
-                log.debug("Cycle detected: child %s of %s is already on the current path", child_id, node_id)
-                continue
-            total += self._accumulate_availability(child_id, cache, in_progress)
-        in_progress.discard(node_id)
+    for node_hash, child_hashes in iter_ontology_nodes(_iter_part_lines(part), backend):
+        graph.add_node(node_hash, child_hashes)
 
-        cache[node_id] = total
-        return total
+    return graph
 
-    def _apply_measure(self, context: Dict[str, str], termcode: Dict[str, str], score: int) -> None:
-        node_hash = self._contextualized_hash(context, termcode)
 
-        if node_hash not in self.availability:
-            log.debug("Missing ontology node for %s %s", context, termcode)
-            return
+class ElasticAvailabilityGenerator:
+    """
+    Generates Elasticsearch partial update files that contain availability buckets
+    derived from availability reports and ontology trees.
+    """
 
-        self.availability[node_hash] += score
+    NAMESPACE_UUID = uuid.UUID("00000000-0000-0000-0000-000000000000")
+    FILE_EXTENSION = ".json"
+    MAX_FILESIZE_MB = 10
+    UPDATE_FILE_PREFIX = "es_availability_update"
+    SNAPSHOT_FILE = "availability_snapshot.json.gz"
+    ONTOLOGY_INDEX_FILE = "ontology_index.bin"
+    TERMCODE_INDEX_FILE = "termcode_index.json.gz"
+    ONTOLOGY_ARCHIVE = "elastic.zip"
+    ONTOLOGY_FILE_PATTERN = "*onto_es__ontology*"
+    # Extracted files of at least twice this size are split into byte ranges
+    # that are parsed in parallel, see ontology_workers.
+    MIN_ONTOLOGY_PART_BYTES = 8 * 1024 * 1024
+    BUCKETS = (0, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+    def __init__(
+        self,
+        availability_input_dir: str,
+        availability_output_dir: str,
+        es_ontology_dir: str,
+        ontology_tag: Optional[str] = None,
+        full_refresh: bool = False,
+        use_numpy: bool = False,
+        ontology_index_dir: Optional[str] = None,
+        ontology_workers: int = 1,
+        json_backend: str = "auto",
+        stream_reports: bool = False,
+        report_workers: int = 1,
+        in_memory_reports: bool = False,
+        skip_zero_buckets: bool = False,
+        metrics: Optional[RunMetrics] = None,
+    ) -> None:
+        self.input_dir = Path(availability_input_dir)
+        self.output_dir = Path(availability_output_dir)
+        self.ontology_dir = Path(es_ontology_dir)
+        self.ontology_tag = ontology_tag
+        self.full_refresh = full_refresh
+        self.ontology_index_dir = Path(ontology_index_dir) if ontology_index_dir else None
+        self.ontology_workers = ontology_workers
+        self.json_backend = get_backend(json_backend)
+        self.metrics = metrics or RunMetrics()
+
+        if use_numpy and np is None:
+            log.warning("NumPy is not installed, falling back to the pure-Python roll-up")
+        self.use_numpy = use_numpy and np is not None
+
+        if stream_reports and ijson is None:
+            log.warning("ijson is not installed, loading every report in full")
+        self.stream_reports = stream_reports and ijson is not None
+        self.report_workers = report_workers
+
+        # In in-memory mode, reports are not read from the input dir but
+        # handed over by the downloader as they arrive, already summed up per
+        # termcode key (see parse_report), and merged here.
+        self.in_memory_reports = in_memory_reports
+        self._report_scores: Dict[str, int] = {}
+        self._n_received_reports = 0
+
+        self.skip_zero_buckets = skip_zero_buckets
+        self._n_updates = 0
+
+        # Buckets of the last successful push (non-zero ones only, everything
+        # else is 0) and of the current run, see _build_updates.
+        self._previous_buckets: Optional[Dict[str, int]] = None
+        self._snapshot_buckets: Optional[Dict[str, int]] = None
+        self._current_buckets: Dict[str, int] = {}
+
+        # The ontology export easily runs into the hundreds of thousands of
+        # nodes. Only the child hashes are ever read, and the hierarchy is
+        # kept in flat arrays instead of per-node dicts and lists, which cost
+        # several times as much memory, see OntologyGraph.
+        self.graph = OntologyGraph()
+
+        # Node of every context/termcode key (see termcode_key) seen in a
+        # report so far, None if it is not in the ontology. The same keys
+        # come up in the report of every site, so each is hashed and looked
+        # up only once per run. With an ontology index dir, the table is kept
+        # there for the next run with the same ontology index key.
+        self._node_by_termcode: Dict[str, Optional[int]] = {}
+        self._index_key: Optional[str] = None
+        self._n_stored_termcodes = 0
 
-    def update_from_reports(self) -> None:
-        for file in self.input_dir.glob("*availability_report*"):
-            log.info("Processing report %s", file)
+        mapping_file = self.input_dir / "stratum-to-context.json"
+        self.stratum_to_context = json.loads(mapping_file.read_text(encoding="utf-8"))
 
-            report = json.loads(file.read_text(encoding="utf-8"))
+    def _contextualized_hash(self, key: str) -> str:
+        """Create stable UUID3 hash for a context/termcode key (see termcode_key)."""
+        return str(uuid.uuid3(self.NAMESPACE_UUID, key))
+
+    def _ontology_files(self) -> List[Path]:
+        """The extracted ontology export files, or else the unextracted export archive."""
+        files = sorted((self.ontology_dir / "elastic").glob(self.ONTOLOGY_FILE_PATTERN))
+        archive = self.ontology_dir / self.ONTOLOGY_ARCHIVE
+        if not files and archive.exists():
+            return [archive]
+        return files
+
+    def _ontology_parts(self, files: List[Path], n_workers: int) -> List[OntologyPart]:
+        """
+        Splits the ontology export into parts in export order: one per file or
+        archive member, large extracted files into several byte ranges when
+        parsing with more than one worker.
+        """
+        parts: List[OntologyPart] = []
+        for file in files:
+            if file.suffix == ".zip":
+                with zipfile.ZipFile(file) as zf:
+                    for name in sorted(zf.namelist()):
+                        if fnmatch(PurePosixPath(name).name, self.ONTOLOGY_FILE_PATTERN):
+                            parts.append((str(file), name, 0, None))
+                continue
 
-            for group in report.get("group", []):
-                for stratifier in group.get("stratifier", []):
-                    if "stratum" not in stratifier:
-                        continue
+            n_parts = min(n_workers, file.stat().st_size // self.MIN_ONTOLOGY_PART_BYTES)
+            if n_parts < 2:
+                parts.append((str(file), None, 0, None))
+                continue
+            parts.extend((str(file), None, start, end) for start, end in split_ontology_file(file, n_parts))
+        return parts
+
+    def _ontology_index_key(self, files: List[Path]) -> str:
+        """Identifies an ontology release by its tag and a checksum over its export files."""
+        digest = hashlib.sha256()
+        for file in files:
+            digest.update(file.name.encode("utf-8") + b"\0")
+            with file.open("rb") as fh:
+                for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        return f"{self.ontology_tag or ''}:{digest.hexdigest()}"
 
-                    strat_code = stratifier["code"][0]["coding"][0]["code"]
+    def load_ontology_tree(self) -> None:
+        """
+        Loads ontology export (newline-delimited JSON), either extracted into
+        the `elastic` dir or as the `elastic.zip` archive. With an ontology index
+        dir, the parsed graph is kept there as a binary index and memory-mapped
+        on later runs for the same release instead of parsing the export again.
+        """
+        files = self._ontology_files()
+        self._node_by_termcode = {}
+        self._n_stored_termcodes = 0
+
+        index_file = index_key = None
+        if self.ontology_index_dir is not None:
+            index_file = self.ontology_index_dir / self.ONTOLOGY_INDEX_FILE
+            index_key = self._ontology_index_key(files)
+            self._index_key = index_key
+            graph = OntologyGraph.load(index_file, index_key)
+            if graph is not None:
+                self.graph = graph
+                log.info("Loaded %d ontology nodes from index %s", len(graph), index_file)
+                self._load_termcode_index()
+                return
+
+        # Files are read line by line and only the node and child hashes are
+        # kept, so memory use is bounded by the graph and not the export size.
+        parts = self._ontology_parts(files, self.ontology_workers)
+        n_workers = min(self.ontology_workers, len(parts))
+        graph = OntologyGraph()
+
+        if n_workers > 1:
+            # Each worker builds the arrays of its part, which are appended in
+            # export order, so the result is the same as when loading serially.
+            log.info("Loading %d ontology file parts with %d workers", len(parts), n_workers)
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                parse = partial(parse_ontology_part, json_backend=self.json_backend.name)
+                for part_graph in executor.map(parse, parts):
+                    graph.merge(part_graph)
+        else:
+            for part in parts:
+                log.info("Loading ontology file %s", part[0] if part[1] is None else f"{part[0]}:{part[1]}")
+                parse_ontology_part(part, graph, self.json_backend.name)
+
+        graph.finalize()
+        self.graph = graph
+
+        log.info("Loaded %d ontology nodes", len(graph))
+
+        if index_file is not None:
+            try:
+                graph.save(index_file, index_key)
+                log.info("Wrote ontology index %s", index_file)
+            except OSError as e:
+                log.warning("Could not write ontology index %s: %s", index_file, e)
+
+    def _load_termcode_index(self) -> None:
+        """Loads the node of every context/termcode key stored by an earlier run for this ontology index."""
+        index_file = self.ontology_index_dir / self.TERMCODE_INDEX_FILE
+        try:
+            with gzip.open(index_file, "rt", encoding="utf-8") as fh:
+                index = json.load(fh)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable termcode index %s: %s", index_file, e)
+            return
 
-                    if strat_code not in self.stratum_to_context and strat_code not in PATIENT_STRAT_TO_TERMCODE:
-                        log.debug("Skipping unknown stratifier %s", strat_code)
-                        continue
+        if index.get("key") != self._index_key:
+            return
 
-                    context = self.stratum_to_context.get(strat_code)
+        self._node_by_termcode = index["nodes"]
+        self._n_stored_termcodes = len(self._node_by_termcode)
+        log.info("Loaded %d termcode nodes from index %s", self._n_stored_termcodes, index_file)
 
-                    if strat_code in PATIENT_STRAT_TO_TERMCODE:
-                        termcode = PATIENT_STRAT_TO_TERMCODE[strat_code]
-                        score = sum(s["measureScore"]["value"] for s in stratifier["stratum"])
-                        self._apply_measure(context, termcode, score)
-                        continue
+    def _save_termcode_index(self) -> None:
+        """Stores the termcode nodes looked up so far next to the ontology index, if any were added."""
+        if self._index_key is None or len(self._node_by_termcode) == self._n_stored_termcodes:
+            return
 
-                    for stratum in stratifier["stratum"]:
-                        coding = stratum["value"]["coding"][0]
+        index_file = self.ontology_index_dir / self.TERMCODE_INDEX_FILE
+        try:
+            with atomic_write(index_file) as raw, gzip.open(raw, "wt", encoding="utf-8") as fh:
+                json.dump({"key": self._index_key, "nodes": self._node_by_termcode}, fh,
+                          separators=(",", ":"))
+        except OSError as e:
+            log.warning("Could not write termcode index %s: %s", index_file, e)
+            return
 
-                        if "system" not in coding:
-                            continue
+        self._n_stored_termcodes = len(self._node_by_termcode)
+        log.info("Saved %d termcode nodes to index %s", self._n_stored_termcodes, index_file)
 
-                        termcode = {"system": coding["system"], "code": coding["code"]}
-                        score = stratum["measureScore"]["value"]
+    def _bucketize(self, value: int) -> int:
+        return self.BUCKETS[max(bisect_right(self.BUCKETS, value) - 1, 0)]
+
+    def _bucketize_all(self, totals: array) -> Iterable[int]:
+        """Buckets of all nodes, in graph order."""
+        if not self.use_numpy:
+            return map(self._bucketize, totals)
+
+        thresholds = np.array(self.BUCKETS, dtype=np.int64)
+        positions = np.searchsorted(thresholds, np.frombuffer(totals, dtype=np.int64), side="right") - 1
+        buckets = array("q")
+        buckets.frombytes(thresholds[np.maximum(positions, 0)].tobytes())
+        return buckets
+
+    def _rollup(self) -> array:
+        """Returns the availability of every node (by graph id) including all its descendants."""
+        if self.use_numpy:
+            return self.graph.rollup_numpy()
+        return self.graph.rollup()
+
+    def _timed_rollup(self) -> array:
+        with self.metrics.stage("rollup") as stage:
+            totals = self._rollup()
+            stage.count("nodes", len(totals))
+        return totals
+
+    def _find_termcode(self, key: str) -> Optional[int]:
+        """Node of a context/termcode key (see termcode_key), None if it is not in the ontology."""
+        node = self._node_by_termcode.get(key, _NOT_LOOKED_UP)
+        if node is _NOT_LOOKED_UP:
+            node = self._node_by_termcode[key] = self.graph.find(self._contextualized_hash(key))
+            if node is None:
+                log.debug("Missing ontology node for %s", key)
+        return node
+
+    def _apply_score(self, key: str, score: int) -> None:
+        node = self._find_termcode(key)
+        if node is not None:
+            self.graph.availability[node] += score
+
+    def _apply_scores(self, scores: Dict[str, int]) -> None:
+        """Adds the per-termcode totals of a report to the availability of their nodes."""
+        nodes = array("q")
+        values = array("q")
+        for key, score in scores.items():
+            node = self._find_termcode(key)
+            if node is not None:
+                nodes.append(node)
+                values.append(score)
+
+        if self.use_numpy:
+            np.add.at(np.frombuffer(self.graph.availability, dtype=np.int64),
+                      np.frombuffer(nodes, dtype=np.int64), np.frombuffer(values, dtype=np.int64))
+        else:
+            availability = self.graph.availability
+            for node, value in zip(nodes, values):
+                availability[node] += value
+
+    def parse_report(self, data: bytes) -> Dict[str, int]:
+        """
+        Sums up the scores of a MeasureReport per termcode key, for
+        add_report_scores(). Does not touch the generator's state, so reports
+        can be parsed in the threads that download them.
+        """
+        return _sum_scores(iter_report_scores(io.BytesIO(data), self.stratum_to_context,
+                                              self.json_backend.name, self.stream_reports))
+
+    def add_report_scores(self, scores: Dict[str, int]) -> None:
+        """Adds a report parsed with parse_report() for update_from_reports() in in-memory mode."""
+        totals = self._report_scores
+        for key, score in scores.items():
+            totals[key] = totals.get(key, 0) + score
+        self._n_received_reports += 1
+
+    def update_from_reports(self) -> int:
+        """Applies the reports in the input dir (or received in memory) and returns their number."""
+        if self.in_memory_reports:
+            log.info("Applying %d reports received in memory", self._n_received_reports)
+            self._apply_scores(self._report_scores)
+            self._report_scores = {}
+            return self._n_received_reports
+
+        files = list(self.input_dir.glob("*availability_report*"))
+        n_workers = min(self.report_workers, len(files))
+
+        if n_workers > 1:
+            # Workers only parse and sum up their report per termcode; totals
+            # are integers, so merging them in any order gives exactly the
+            # result of applying every stratum in turn.
+            log.info("Processing %d reports with %d workers", len(files), n_workers)
+            aggregate = partial(aggregate_report, stratum_to_context=self.stratum_to_context,
+                                json_backend=self.json_backend.name, stream=self.stream_reports)
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                for file, scores in zip(files, executor.map(aggregate, map(str, files))):
+                    log.info("Processed report %s", file)
+                    self._apply_scores(scores)
+            return len(files)
+
+        for file in files:
+            log.info("Processing report %s", file)
 
-                        self._apply_measure(context, termcode, score)
+            with file.open("rb") as fh:
+                for key, score in iter_report_scores(fh, self.stratum_to_context,
+                                                     self.json_backend.name, self.stream_reports):
+                    self._apply_score(key, score)
+
+        return len(files)
+
+    def _load_snapshot(self) -> Optional[Dict[str, int]]:
+        """Returns the buckets pushed by the last run for this ontology tag, or None if unknown."""
+        if self.ontology_tag is None:
+            return None
+
+        snapshot_file = self.output_dir / self.SNAPSHOT_FILE
+        try:
+            with gzip.open(snapshot_file, "rt", encoding="utf-8") as fh:
+                snapshot = json.load(fh)
+        except FileNotFoundError:
+            log.info("No availability snapshot found, sending all nodes")
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable availability snapshot %s: %s", snapshot_file, e)
+            return None
+
+        if snapshot.get("ontology_tag") != self.ontology_tag:
+            log.info("Availability snapshot is for ontology %s, not %s, sending all nodes",
+                     snapshot.get("ontology_tag"), self.ontology_tag)
+            return None
+
+        return snapshot["buckets"]
+
+    def invalidate_snapshot(self) -> None:
+        """
+        Removes the snapshot before the first update is sent. A run that fails
+        after some of its bulk requests were applied leaves the index apart
+        from the snapshot in unknown nodes, so the next run has to send every
+        node.
+        """
+        (self.output_dir / self.SNAPSHOT_FILE).unlink(missing_ok=True)
+
+    def save_snapshot(self) -> None:
+        """
+        Records the buckets of this run as pushed. Must only be called once the
+        updates actually reached Elasticsearch, otherwise the next run would
+        skip nodes the index never received.
+        """
+        if self.ontology_tag is None:
+            return
 
-    def _write_chunked(self, records: Iterable[List[Dict[str, Any]]], prefix: str) -> None:
+        snapshot_file = self.output_dir / self.SNAPSHOT_FILE
+        with atomic_write(snapshot_file) as raw, gzip.open(raw, "wt", encoding="utf-8") as fh:
+            json.dump({"ontology_tag": self.ontology_tag, "buckets": self._current_buckets}, fh,
+                      separators=(",", ":"))
 
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+        log.info("Saved availability snapshot with %d non-zero nodes", len(self._current_buckets))
 
-        file_index = 1
-        current_size = 0
+    def _chunk_records(self, records: Iterable[Union[bytes, List[Dict[str, Any]]]]) -> Iterator[bytes]:
+        """
+        Groups records into NDJSON bulk bodies of at most MAX_FILESIZE_MB, never
+        splitting a record. Records are lists of docs or already encoded NDJSON.
+        """
         max_bytes = self.MAX_FILESIZE_MB * 1024 * 1024
+        dumps = self.json_backend.dumps
 
-        fh = (self.output_dir / f"{prefix}_{file_index}{self.FILE_EXTENSION}").open("w", encoding="utf-8")
+        parts: List[bytes] = []
+        current_size = 0
 
         for record in records:
-            lines = [json.dumps(doc, ensure_ascii=False) + "\n" for doc in record]
-            encoded = [line.encode("utf-8") for line in lines]
-            record_size = sum(len(chunk) for chunk in encoded)
-
-            if current_size > 0 and current_size + record_size > max_bytes:
-                fh.close()
-                file_index += 1
-                fh = (self.output_dir / f"{prefix}_{file_index}{self.FILE_EXTENSION}").open("w", encoding="utf-8")
+            if isinstance(record, bytes):
+                data = record
+            else:
+                data = b"".join(dumps(doc) + b"\n" for doc in record)
+
+            if current_size > 0 and current_size + len(data) > max_bytes:
+                yield b"".join(parts)
+                parts = []
                 current_size = 0
 
-            for line in lines:
-                fh.write(line)
-            current_size += record_size
+            parts.append(data)
+            current_size += len(data)
 
-        fh.close()
+        if parts:
+            yield b"".join(parts)
 
-    def _build_updates(self, cache: Dict[str, int]) -> Iterable[List[Dict[str, Any]]]:
-        for node_id in self.availability:
-            total = self._accumulate_availability(node_id, cache)
-            bucket = self._bucketize(total)
+    def _remove_stale_files(self, prefix: str) -> None:
+        # Files left over from a previous, larger run would otherwise be
+        # uploaded again together with the current ones.
+        for stale in self.output_dir.glob(f"{prefix}_*{self.FILE_EXTENSION}"):
+            stale.unlink()
 
+    def _tee_to_files(self, bodies: Iterable[bytes], prefix: str) -> Iterator[bytes]:
+        """Writes every body to its own numbered file while passing it on."""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._remove_stale_files(prefix)
+
+        for file_index, body in enumerate(bodies, start=1):
+            (self.output_dir / f"{prefix}_{file_index}{self.FILE_EXTENSION}").write_bytes(body)
+            yield body
+
+    def _write_chunked(self, records: Iterable[Union[bytes, List[Dict[str, Any]]]], prefix: str) -> None:
+        for _ in self._tee_to_files(self._chunk_records(records), prefix):
+            pass
+
+    def _build_updates(self, totals: array) -> Iterable[bytes]:
+        """
+        Yields the update/doc line pair of every node whose bucket changed,
+        already encoded. The lines are filled into byte templates instead of
+        going through a JSON serializer per node; they are the exact bytes
+        json.dumps(doc, ensure_ascii=False) produces for the docs.
+        """
+        previous = self._previous_buckets
+        skip_zero = self.skips_zero_buckets
+        # nodes the index may still hold as non-zero have to be sent with 0
+        pushed = (self._snapshot_buckets or {}) if skip_zero else None
+        n_updates = 0
+        doc_lines: Dict[int, bytes] = {}
+
+        for node_id, total, bucket in zip(self.graph.iter_ids(), totals, self._bucketize_all(totals)):
             if total > 0:
                 log.debug("Node %s → %d (bucket %d)", node_id, total, bucket)
 
-            yield [{"update": {"_id": node_id}}, {"doc": {"availability": bucket}}]
+            if bucket:
+                self._current_buckets[node_id] = bucket
+
+            if previous is not None and previous.get(node_id, 0) == bucket:
+                continue
+            if skip_zero and not bucket and not pushed.get(node_id):
+                continue
+
+            doc_line = doc_lines.get(bucket)
+            if doc_line is None:
+                doc_line = doc_lines[bucket] = json.dumps({"doc": {"availability": int(bucket)}}).encode("utf-8") + b"\n"
+
+            n_updates += 1
+            yield _action_line("update", node_id) + doc_line
+
+        self._n_updates = n_updates
+        log.info("%d of %d nodes changed their availability bucket", n_updates, len(self.graph))
+
+    def prepare(self) -> None:
+        """Loads the ontology and applies all reports, so that updates can be built."""
+        with self.metrics.stage("ontology_load") as stage:
+            self.load_ontology_tree()
+            stage.count("nodes", len(self.graph))
+
+        with self.metrics.stage("report_aggregation") as stage:
+            stage.count("reports", self.update_from_reports())
+            self._save_termcode_index()
+            stage.count("termcodes", len(self._node_by_termcode))
+
+        # With full_refresh every node is sent, but the snapshot still tells
+        # which nodes the index holds as non-zero.
+        self._snapshot_buckets = self._load_snapshot()
+        self._previous_buckets = None if self.full_refresh else self._snapshot_buckets
+        self._current_buckets = {}
+
+    @property
+    def skips_zero_buckets(self) -> bool:
+        """
+        Whether the updates of this run leave out nodes in bucket 0. Without a
+        snapshot or with full_refresh, every node would be sent, most of them
+        with availability 0; with skip_zero_buckets, only nodes that are or
+        were non-zero are sent instead. Only known after prepare().
+        """
+        return self.skip_zero_buckets and self._previous_buckets is None
+
+    @property
+    def resets_index(self) -> bool:
+        """
+        Whether the index has to be reset to 0 before the updates are sent, as
+        zero buckets are left out and it is not known which nodes the index
+        holds as non-zero: for a new ontology tag or without a snapshot. With
+        a snapshot, nodes that were non-zero in it are sent with 0 instead, so
+        the live index does not drop to 0 while it is refilled.
+        """
+        return self.skips_zero_buckets and self._snapshot_buckets is None
+
+    def bulk_bodies(self, keep_files: bool = False) -> Iterator[bytes]:
+        """
+        Yields the availability update as ready-to-send bulk request bodies
+        while it is being computed, so the caller can upload it without a
+        round trip through the output dir. With keep_files the bodies are
+        written to it as well, e.g. for debugging.
+        """
+        bodies = self._chunk_records(self._build_updates(self._timed_rollup()))
+
+        if keep_files:
+            yield from self._tee_to_files(bodies, self.UPDATE_FILE_PREFIX)
+        else:
+            self._remove_stale_files(self.UPDATE_FILE_PREFIX)
+            yield from bodies
+
+    def index_bodies(self) -> Iterator[bytes]:
+        """
+        Yields the complete ontology export with the availability bucket of
+        every node merged into its document, as bulk bodies of index actions
+        for a new index (see the blue-green update mode). The actions carry no
+        `_index`, so they go to the index the bodies are sent to.
+        """
+        totals = self._timed_rollup()
+        buckets = array("q", self._bucketize_all(totals))
+        self._current_buckets = {node_id: bucket for node_id, bucket in zip(self.graph.iter_ids(), buckets) if bucket}
+
+        yield from self._chunk_records(self._build_documents(buckets))
+
+    def _build_documents(self, buckets: array) -> Iterator[bytes]:
+        loads, dumps = self.json_backend.loads, self.json_backend.dumps
+        n_docs = 0
+
+        for part in self._ontology_parts(self._ontology_files(), 1):
+            for node_hash, line in iter_ontology_documents(_iter_part_lines(part), self.json_backend):
+                node = self.graph.find(node_hash)
+                doc = loads(line)
+                doc["availability"] = int(buckets[node]) if node is not None else 0
+
+                n_docs += 1
+                yield _action_line("index", node_hash) + dumps(doc) + b"\n"
+
+        log.info("Built %d ontology documents", n_docs)
 
     def generate(self) -> None:
         """Main pipeline."""
-        self.load_ontology_tree()
-        self.update_from_reports()
+        self.prepare()
 
         # Records are streamed straight into _write_chunked rather than collected
         # into a list first: materializing all ~700k update/doc pairs up front
         # roughly doubled peak memory on top of the ontology tree itself.
-        cache: Dict[str, int] = {}
-        self._write_chunked(self._build_updates(cache), "es_availability_update")
+        totals = self._timed_rollup()
+        with self.metrics.stage("write_updates") as stage:
+            self._write_chunked(self._build_updates(totals), self.UPDATE_FILE_PREFIX)
+            stage.count("updates", self._n_updates)
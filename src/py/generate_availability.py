@@ -1,25 +1,64 @@
 import argparse
+import gzip
+import hashlib
 import json
 import logging
+import os
+import random
 import re
 import shutil
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Optional
-from urllib.parse import urlparse
-import io
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urljoin, urlparse
 from requests.auth import HTTPBasicAuth
 import tempfile
+import threading
+import time
 import certifi
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from atomic_file import write_atomic
 from elastic_availability_generator import ElasticAvailabilityGenerator
+from json_backend import BACKENDS
+from profiling import PROFILE_MODES, StageProfiler
+from run_metrics import RunMetrics
 
 log = logging.getLogger(__name__)
 
 PROJECT_IDENTIFIER_SYSTEM = "http://medizininformatik-initiative.de/sid/project-identifier"
 
+# Bulk responses (or single bulk items) with these statuses mean Elasticsearch
+# is overloaded rather than that the update is invalid, so they are retried.
+BULK_RETRY_STATUSES = (429, 503)
+BULK_RETRY_BACKOFF_SECONDS = 1.0
+BULK_RETRY_MAX_BACKOFF_SECONDS = 60.0
+MAX_LOGGED_BULK_ERRORS = 10
+# Bulk bodies are highly repetitive NDJSON, the fastest level already
+# compresses them to a small fraction of their size.
+BULK_GZIP_LEVEL = 1
+ES_RESET_TIMEOUT_SECONDS = 1800
+
+RUN_SUMMARY_FILE = "run_summary.json"
+PROFILE_DIR = "profile"
+
+ES_UPDATE_MODES = ("update", "blue-green")
+# Index settings ES sets itself and refuses when creating an index.
+ES_PRIVATE_INDEX_SETTINGS = ("uuid", "creation_date", "provided_name", "version", "routing", "resize",
+                             "history_uuid", "verified_before_close")
+
+ZIP_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+ZIP_DOWNLOAD_MAX_RETRIES = 5
+ZIP_DOWNLOAD_BACKOFF_SECONDS = 2.0
+ZIP_DOWNLOAD_MAX_BACKOFF_SECONDS = 30.0
+
+DOCREF_PAGE_SIZE = 500
+DOCREF_ELEMENTS = "masterIdentifier,author,content,date"
+
 FHIR_REF = re.compile(r"(?:^|/)([A-Z][A-Za-z]{1,64}/[A-Za-z0-9\-.]{1,64}"
                       r"(?:/_history/[A-Za-z0-9\-.]{1,64})?)/?$")
 
@@ -31,6 +70,13 @@ def resolve(base: str, url: str) -> str:
     return f"{base.rstrip('/')}/{m.group(1)}"
 
 
+class ReleaseArchive(NamedTuple):
+    """A downloaded release archive and the files it put on disk."""
+    sha256: str
+    etag: Optional[str]
+    files: Tuple[str, ...] = ()
+
+
 def get_combined_ca_bundle(custom_ca_path: Optional[str] = None) -> Optional[str]:
     """
     Return a CA bundle path that includes both system CAs and optional custom CA.
@@ -108,12 +154,7 @@ def build_onto_repo_auth(username: Optional[str], password: Optional[str]) -> Op
     return None
 
 
-def download_and_unzip(session, url: str, extract_to: Path, auth: Optional[HTTPBasicAuth] = None) -> None:
-    log.info("Downloading %s", url)
-
-    resp = session.get(url, timeout=120, auth=auth)
-    resp.raise_for_status()
-
+def _check_zip_response(resp) -> None:
     content_type = resp.headers.get("Content-Type", "")
     if "zip" not in content_type and "octet-stream" not in content_type:
         raise RuntimeError(
@@ -121,21 +162,282 @@ def download_and_unzip(session, url: str, extract_to: Path, auth: Optional[HTTPB
             f"First 200 bytes:\n{resp.text[:200]}"
         )
 
-    data = io.BytesIO(resp.content)
 
-    # extract_to is a persistent dir across runs; stale files from a previous
-    # release must not linger and get merged with the newly extracted ones.
-    if extract_to.exists():
-        shutil.rmtree(extract_to)
-    extract_to.mkdir(parents=True, exist_ok=True)
+def _download_zip(
+    session,
+    url: str,
+    target: Path,
+    auth: Optional[HTTPBasicAuth] = None,
+    sha256: Optional[str] = None,
+    if_none_match: Optional[str] = None,
+    max_retries: int = ZIP_DOWNLOAD_MAX_RETRIES,
+    backoff: float = ZIP_DOWNLOAD_BACKOFF_SECONDS,
+) -> Optional[ReleaseArchive]:
+    """
+    Streams the archive at url to target chunk by chunk, so memory use does
+    not grow with the size of the archive. A transfer that breaks off is
+    resumed with a Range request from where it stopped (conditional on the
+    ETag or Last-Modified of the first response, so two versions of the
+    archive are never joined), or restarted if the server does not support
+    ranges or the archive changed. Failed connects are retried as well. The
+    archive is checked against sha256, or the X-Checksum-Sha256 header sent
+    by artifactory if not given. Returns None if the server answers
+    if_none_match with 304.
+    """
+    log.info("Downloading %s", url)
 
-    with zipfile.ZipFile(data) as zf:
-        zf.extractall(extract_to)
+    digest = hashlib.sha256()
+    expected = sha256
+    etag = None
+    validator = None
+    offset = 0
+    attempt = 0
+
+    with target.open("wb") as fh:
+        while True:
+            if offset:
+                headers = {"Range": f"bytes={offset}-"}
+                if validator:
+                    headers["If-Range"] = validator
+            else:
+                headers = {"If-None-Match": if_none_match} if if_none_match else None
+            resp = None
+            try:
+                resp = session.get(url, timeout=120, auth=auth, stream=True, headers=headers)
+                if resp.status_code == 304:
+                    log.info("%s not modified", url)
+                    return None
+                resp.raise_for_status()
+                _check_zip_response(resp)
+
+                if offset and resp.status_code != 206:
+                    log.warning("Server ignored the range request or the archive changed, restarting download of %s",
+                                url)
+                    fh.seek(0)
+                    fh.truncate()
+                    digest = hashlib.sha256()
+                    offset = 0
+                    validator = None
+                    expected = sha256
+
+                expected = expected or resp.headers.get("X-Checksum-Sha256")
+                if not offset:
+                    etag = resp.headers.get("ETag")
+                    # If-Range only accepts a strong ETag
+                    validator = etag if etag and not etag.startswith("W/") else resp.headers.get("Last-Modified")
+                for chunk in resp.iter_content(chunk_size=ZIP_DOWNLOAD_CHUNK_SIZE):
+                    fh.write(chunk)
+                    digest.update(chunk)
+                    offset += len(chunk)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                log.warning("Download of %s interrupted after %d bytes (%s), resuming", url, offset, e)
+                time.sleep(_retry_delay(attempt - 1, backoff, ZIP_DOWNLOAD_MAX_BACKOFF_SECONDS))
+            finally:
+                if resp is not None:
+                    resp.close()
+
+    actual = digest.hexdigest()
+    if not expected:
+        log.warning("No sha256 known for %s, the archive is not verified (see --onto-checksums)", url)
+    elif actual != expected.lower():
+        raise RuntimeError(f"Checksum mismatch for {url}: expected sha256 {expected}, got {actual}")
+
+    log.info("Downloaded %d bytes from %s", offset, url)
+    return ReleaseArchive(actual, etag)
+
+
+def _clear_dir(path: Path) -> None:
+    # path is a persistent dir across runs; stale files from a previous
+    # release must not linger and get merged with the newly downloaded ones.
+    # Only the content is removed, as path may be a mount point.
+    path.mkdir(parents=True, exist_ok=True)
+    for entry in path.iterdir():
+        if entry.is_dir() and not entry.is_symlink():
+            shutil.rmtree(entry)
+        else:
+            entry.unlink()
+
+
+def _swap_dir(staging: Path, target: Path) -> None:
+    """Replaces target by staging. Readers see either the old or the new content."""
+    old = target.with_name(f".{target.name}.old")
+    shutil.rmtree(old, ignore_errors=True)
+    try:
+        if target.exists():
+            target.rename(old)
+    except OSError:
+        # target is a mount point (e.g. a docker volume) and cannot be
+        # renamed, so fall back to replacing its content instead. staging is
+        # on another filesystem then, so entries are copied over by move.
+        _clear_dir(target)
+        for entry in staging.iterdir():
+            shutil.move(str(entry), str(target / entry.name))
+        staging.rmdir()
+        return
+
+    staging.rename(target)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def download_and_unzip(
+    session,
+    url: str,
+    extract_to: Path,
+    auth: Optional[HTTPBasicAuth] = None,
+    sha256: Optional[str] = None,
+    if_none_match: Optional[str] = None,
+) -> Optional[ReleaseArchive]:
+    """
+    Downloads the archive at url and extracts it to extract_to, replacing its
+    previous content only once the archive is complete and extracted.
+    Returns None, leaving extract_to as it is, if the archive is not modified
+    since the download with ETag if_none_match.
+    """
+    archive_path = extract_to.with_name(f".{extract_to.name}.zip.part")
+    staging = extract_to.with_name(f".{extract_to.name}.extracting")
+    try:
+        archive = _download_zip(session, url, archive_path, auth=auth, sha256=sha256, if_none_match=if_none_match)
+        if archive is None:
+            return None
+
+        shutil.rmtree(staging, ignore_errors=True)
+        with zipfile.ZipFile(archive_path) as zf:
+            files = [name for name in zf.namelist() if not name.endswith("/")]
+            zf.extractall(staging)
+        _swap_dir(staging, extract_to)
+    finally:
+        archive_path.unlink(missing_ok=True)
+        shutil.rmtree(staging, ignore_errors=True)
 
     log.info("Extracted to %s", extract_to)
+    return archive._replace(files=tuple(files))
+
+
+def download_zip(
+    session,
+    url: str,
+    target: Path,
+    auth: Optional[HTTPBasicAuth] = None,
+    sha256: Optional[str] = None,
+    if_none_match: Optional[str] = None,
+) -> Optional[ReleaseArchive]:
+    """Like download_and_unzip, but stores the archive itself as `target` instead of extracting it."""
+    # Outside target.parent, which is cleared before the archive is moved in.
+    part = target.parent.with_name(f".{target.parent.name}.{target.name}.part")
+    try:
+        archive = _download_zip(session, url, part, auth=auth, sha256=sha256, if_none_match=if_none_match)
+        if archive is None:
+            return None
+
+        _clear_dir(target.parent)
+        os.replace(part, target)
+    finally:
+        part.unlink(missing_ok=True)
+
+    log.info("Saved to %s", target)
+    return archive._replace(files=(target.name,))
+
+
+def read_checksums(path: Path) -> Dict[str, str]:
+    """Reads a file in the format of sha256sum (`<sha256>  <file name>` per line) into file name -> sha256."""
+    checksums = {}
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        if not line.strip():
+            continue
+        digest, name = line.split(maxsplit=1)
+        # sha256sum marks files read in binary mode with *
+        checksums[name.strip().lstrip("*")] = digest.lower()
+    return checksums
+
+
+class ReleaseManifest:
+    """
+    Records the ontology release archives currently on disk: the tag and URL
+    they were downloaded from, their ETag and sha256 and the files they put
+    on disk. An archive that is still on disk is not downloaded again, or
+    only conditionally if the server sent an ETag for it.
+    """
+
+    FILE = ".release-manifest.json"
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        try:
+            self.entries: Dict[str, dict] = json.loads(self.path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError:
+            log.warning("Ignoring unreadable release manifest %s", self.path)
+            self.entries = {}
+
+    def lookup(self, name: str, url: str, extracted: bool, root: Path) -> Optional[dict]:
+        """The entry of archive name if it was downloaded from url and all its files are still in root."""
+        entry = self.entries.get(name)
+        if (entry is None or entry.get("url") != url or entry.get("extracted") != extracted
+                or not all((root / file).is_file() for file in entry.get("files", ()))):
+            return None
+        return entry
+
+    def store(self, name: str, tag: str, url: str, extracted: bool, archive: ReleaseArchive) -> None:
+        self.entries[name] = {
+            "tag": tag,
+            "url": url,
+            "extracted": extracted,
+            "etag": archive.etag,
+            "sha256": archive.sha256,
+            "files": list(archive.files),
+        }
+        # The directory of the manifest may just have been replaced.
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.path, json.dumps(self.entries, indent=2, sort_keys=True).encode("utf-8"))
+
+
+def update_release_archive(
+    session,
+    manifest: ReleaseManifest,
+    tag: str,
+    url: str,
+    target: Path,
+    extract: bool = True,
+    auth: Optional[HTTPBasicAuth] = None,
+    sha256: Optional[str] = None,
+) -> bool:
+    """
+    Puts the archive at url into target, extracted (download_and_unzip) or as
+    is (download_zip), unless the manifest shows it is already there. Returns
+    whether the archive was downloaded. With sha256, an archive on disk with
+    another checksum is downloaded again and the download is verified.
+    """
+    name = url.rsplit("/", 1)[-1]
+    entry = manifest.lookup(name, url, extract, target if extract else target.parent)
+    if entry is not None and sha256 and entry.get("sha256") != sha256.lower():
+        log.info("%s of %s on disk does not match the expected sha256, downloading it again", name, tag)
+        entry = None
+
+    if entry is not None and not entry.get("etag"):
+        # Without a validator, rely on released tags not being re-published.
+        log.info("%s of %s already on disk, skipping download", name, tag)
+        return False
+
+    etag = entry["etag"] if entry else None
+    if extract:
+        archive = download_and_unzip(session, url, target, auth=auth, sha256=sha256, if_none_match=etag)
+    else:
+        archive = download_zip(session, url, target, auth=auth, sha256=sha256, if_none_match=etag)
+
+    if archive is None:
+        log.info("%s of %s unchanged, keeping the files on disk", name, tag)
+        return False
 
+    manifest.store(name, tag, url, extract, archive)
+    return True
 
-def _filter_availability_docrefs(entries: List[dict], master_ident: str) -> List[dict]:
+
+def _filter_availability_docrefs(entries: Iterable[dict], master_ident: str) -> List[dict]:
 
     matches = []
 
@@ -149,47 +451,462 @@ def _filter_availability_docrefs(entries: List[dict], master_ident: str) -> List
     return matches
 
 
+def _iter_search_entries(session: requests.Session, url: str, params: Optional[dict] = None) -> Iterator[dict]:
+    """Yield the entries of a FHIR search, following Bundle.link[next] page by page."""
+    while url:
+        log.info("Querying %s", url)
+
+        response = session.get(url, params=params, timeout=60)
+        response.raise_for_status()
+        bundle = response.json()
+
+        yield from bundle.get("entry", [])
+
+        # The next link already carries all search parameters.
+        params = None
+        next_url = next((link.get("url") for link in bundle.get("link", []) if link.get("relation") == "next"), None)
+        url = urljoin(url, next_url) if next_url else None
+
+
+def _docref_timestamp(docref: dict) -> datetime:
+    value = docref.get("date") or docref.get("meta", {}).get("lastUpdated")
+    try:
+        ts = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return datetime.min.replace(tzinfo=timezone.utc)
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+
+def _latest_docref_per_author(docrefs: Iterable[dict]) -> List[dict]:
+    """Keep only the most recent DocumentReference of every reporting site."""
+    latest: Dict[str, dict] = {}
+
+    for docref in docrefs:
+        try:
+            author = docref["author"][0]["identifier"]["value"]
+        except (KeyError, IndexError):
+            log.warning("Skipping docref %s without author identifier", docref.get("id"))
+            continue
+
+        current = latest.get(author)
+        if current is None or _docref_timestamp(docref) > _docref_timestamp(current):
+            latest[author] = docref
+
+    return list(latest.values())
+
+
+def find_availability_docrefs(session: requests.Session, fhir_base_url: str, master_ident: str) -> List[dict]:
+    # The identifier search also matches DocumentReference.identifier, so the
+    # masterIdentifier is still checked client-side on the (already small)
+    # result set.
+    params = {
+        "identifier": f"{PROJECT_IDENTIFIER_SYSTEM}|{master_ident}",
+        "_elements": DOCREF_ELEMENTS,
+        "_count": DOCREF_PAGE_SIZE,
+        "_format": "json",
+    }
+    entries = _iter_search_entries(session, f"{fhir_base_url}/DocumentReference", params)
+
+    return _latest_docref_per_author(_filter_availability_docrefs(entries, master_ident))
+
+
+class ReportCache:
+    """
+    Persistent per-site cache of downloaded MeasureReports.
+
+    For every author the cache keeps the last report body together with the
+    validators it was served with (ETag, Last-Modified) and the date of the
+    DocumentReference pointing to it. A report whose docref is unchanged is
+    reused without any request; otherwise the download is made conditional
+    so the server can answer 304 instead of resending it.
+    """
+
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+        manifest = self.cache_dir / self.MANIFEST_FILE
+        try:
+            self.entries: Dict[str, dict] = json.loads(manifest.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError:
+            log.warning("Ignoring unreadable report cache manifest %s", manifest)
+            self.entries = {}
+
+    def body_path(self, author: str) -> Path:
+        return self.cache_dir / f"availability_report_{author}.json"
+
+    def lookup(self, author: str, url: str) -> Optional[dict]:
+        with self._lock:
+            entry = self.entries.get(author)
+        if entry is None or entry.get("url") != url or not self.body_path(author).is_file():
+            return None
+        return entry
+
+    def store(self, author: str, entry: dict, body: Optional[bytes] = None) -> None:
+        if body is not None:
+            write_atomic(self.body_path(author), body)
+        with self._lock:
+            self.entries[author] = entry
+
+    def save(self) -> None:
+        with self._lock:
+            data = json.dumps(self.entries, indent=2, sort_keys=True)
+        write_atomic(self.cache_dir / self.MANIFEST_FILE, data.encode("utf-8"))
+
+
+def _report_download_target(fhir_base_url: str, docref: dict) -> Optional[Tuple[str, str, Optional[str]]]:
+    author = docref["author"][0]["identifier"]["value"]
+
+    contents = docref.get("content", [])
+    if len(contents) != 1:
+        log.warning("Skipping docref with unexpected content length")
+        return None
+
+    measure_url = contents[0].get("attachment", {}).get("url")
+    if not measure_url:
+        log.warning("Skipping docref without MeasureReport URL")
+        return None
+
+    return author, resolve(fhir_base_url, measure_url), docref.get("date")
+
+
+def _reuse_cached_report(body_path: Path, outfile: Path, parse: Optional[Callable[[bytes], Any]],
+                         keep_file: bool) -> Any:
+    # The cached body was checked when it was downloaded, so it is only
+    # parsed if the caller needs the result.
+    if parse is None and not keep_file:
+        return None
+    body = body_path.read_bytes()
+    if keep_file:
+        write_atomic(outfile, body)
+    return parse(body) if parse else None
+
+
+def _download_report(
+    session: requests.Session,
+    input_dir: Path,
+    author: str,
+    url: str,
+    docref_date: Optional[str] = None,
+    cache: Optional[ReportCache] = None,
+    parse: Optional[Callable[[bytes], Any]] = json.loads,
+    keep_file: bool = True,
+) -> Tuple[bool, Any]:
+    """
+    Fetches the report of author and parses it with `parse`. With keep_file,
+    the body is placed in input_dir as received. Returns whether the report
+    was downloaded (False if the cached copy was reused) and the parsed report.
+    Without parse, a reused copy is not parsed at all and None is returned.
+    """
+    outfile = input_dir / f"availability_report_{author}.json"
+    cached = cache.lookup(author, url) if cache else None
+
+    if cached and docref_date and cached.get("docref_date") == docref_date:
+        log.debug("Report of %s unchanged since %s, using cached copy", author, docref_date)
+        return False, _reuse_cached_report(cache.body_path(author), outfile, parse, keep_file)
+
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    log.debug("Downloading report %s", url)
+
+    report = session.get(url, allow_redirects=False, params={"_format": "json"}, headers=headers, timeout=(5, 60))
+
+    if cached and report.status_code == 304:
+        log.debug("Report of %s not modified, using cached copy", author)
+        parsed = _reuse_cached_report(cache.body_path(author), outfile, parse, keep_file)
+        cache.store(author, {**cached, "docref_date": docref_date})
+        return False, parsed
+
+    report.raise_for_status()
+
+    # The body is kept as received instead of being decoded and encoded
+    # again; parsing it also makes sure it is valid before it is stored.
+    body = report.content
+    parsed = (parse or json.loads)(body)
+    if keep_file:
+        write_atomic(outfile, body)
+
+    if cache:
+        cache.store(author, {
+            "url": url,
+            "docref_date": docref_date,
+            "etag": report.headers.get("ETag"),
+            "last_modified": report.headers.get("Last-Modified"),
+        }, body)
+
+    return True, parsed
+
+
 def download_availability_reports(
     session: requests.Session,
     input_dir: Path,
     fhir_base_url: str,
     availability_master_ident: str,
+    concurrency: int = 1,
+    cache: Optional[ReportCache] = None,
+    parse_report: Callable[[bytes], Any] = json.loads,
+    on_report: Optional[Callable[[Any], None]] = None,
+    keep_files: bool = True,
 ) -> int:
+    """
+    Downloads the latest report of every site into input_dir and returns the
+    number of reports available. Every report is parsed with parse_report in
+    the thread that downloaded it, and the result passed to on_report in the
+    calling thread, e.g. to aggregate reports in memory while the remaining
+    ones are still downloading. Without on_report, only newly downloaded
+    reports are parsed, to check them. Without keep_files, nothing is
+    written to input_dir. A site whose report fails to download is counted
+    with its last report from the cache, if there is one.
+    """
+    # The input dir is no longer cleared when an unchanged release is kept;
+    # the report of a site that stopped publishing one must not be counted
+    # again.
+    for stale in input_dir.glob("availability_report_*.json"):
+        stale.unlink()
 
-    url = f"{fhir_base_url}/DocumentReference?_count=1000&_format=json"
-    log.info("Querying %s", url)
-
-    response = session.get(url, timeout=60)
-    response.raise_for_status()
-
-    bundle = response.json()
-    docrefs = _filter_availability_docrefs(bundle.get("entry", []), availability_master_ident)
+    docrefs = find_availability_docrefs(session, fhir_base_url, availability_master_ident)
 
     log.info("Found %d matching DocumentReferences", len(docrefs))
 
+    targets = []
     for docref in docrefs:
-        author = docref["author"][0]["identifier"]["value"]
-
-        contents = docref.get("content", [])
-        if len(contents) != 1:
-            log.warning("Skipping docref with unexpected content length")
+        try:
+            target = _report_download_target(fhir_base_url, docref)
+        except ValueError as e:
+            log.warning("Skipping docref %s: %s", docref.get("id"), e)
             continue
+        if target:
+            targets.append(target)
+
+    # Each report is a separate request against a site-specific resource, so
+    # they are fetched in parallel. A failing or slow site only costs its own
+    # worker; the remaining reports are still downloaded and counted.
+    n_available = 0
+    n_downloaded = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {
+            pool.submit(_download_report, session, input_dir, author, report_url, docref_date, cache,
+                        parse_report if on_report else None, keep_files): author
+            for author, report_url, docref_date in targets
+        }
+        for future in as_completed(futures):
+            author = futures[future]
+            try:
+                downloaded, parsed = future.result()
+            except (requests.RequestException, OSError, ValueError) as e:
+                # Dropping the site would publish the availability without
+                # its counts (and snapshot that), so its last report is used.
+                if cache is None or not cache.body_path(author).is_file():
+                    log.error("Failed to download report of %s and no cached copy: %s", author, e)
+                    continue
+                log.warning("Failed to download report of %s, using its last cached report: %s", author, e)
+                try:
+                    downloaded, parsed = False, _reuse_cached_report(
+                        cache.body_path(author), input_dir / f"availability_report_{author}.json",
+                        parse_report if on_report else None, keep_files)
+                except (OSError, ValueError) as e:
+                    log.error("Failed to read the cached report of %s: %s", author, e)
+                    continue
+            if on_report:
+                on_report(parsed)
+            n_available += 1
+            n_downloaded += downloaded
+
+    if cache:
+        cache.save()
+
+    log.info("%d of %d reports available (%d downloaded, %d unchanged)",
+             n_available, len(targets), n_downloaded, n_available - n_downloaded)
+    return n_available
+
+
+class BulkUploadStats:
+    """Thread-safe counters of a bulk upload, summarized once it is done."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.docs = 0
+        self.bytes = 0
+        self.rejected = 0
+        self.retried = 0
+        self.logged_errors = 0
+
+    def add(self, docs: int = 0, nbytes: int = 0, rejected: int = 0, retried: int = 0) -> None:
+        with self._lock:
+            self.docs += docs
+            self.bytes += nbytes
+            self.rejected += rejected
+            self.retried += retried
+
+    def should_log_error(self) -> bool:
+        with self._lock:
+            self.logged_errors += 1
+            return self.logged_errors <= MAX_LOGGED_BULK_ERRORS
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        return (
+            f"{self.docs} docs updated in {elapsed:.1f}s ({self.docs / elapsed:.0f} docs/s, "
+            f"{self.bytes / elapsed / 1024 / 1024:.2f} MB/s), {self.retried} retried, {self.rejected} rejected"
+        )
+
+
+def _split_bulk_actions(body: bytes) -> List[bytes]:
+    """Splits an NDJSON bulk body into its actions, each together with its source line."""
+    lines = [line for line in body.splitlines(keepends=True) if line.strip()]
+    actions = []
+
+    i = 0
+    while i < len(lines):
+        # delete is the only bulk action without a source line
+        if next(iter(json.loads(lines[i]))) == "delete":
+            actions.append(lines[i])
+            i += 1
+        else:
+            actions.append(lines[i] + lines[i + 1])
+            i += 2
+
+    return actions
+
 
-        measure_url = contents[0].get("attachment", {}).get("url")
-        if not measure_url:
-            log.warning("Skipping docref without MeasureReport URL")
+def _retry_delay(attempt: int, backoff: float, max_delay: float = BULK_RETRY_MAX_BACKOFF_SECONDS) -> float:
+    return min(backoff * 2 ** attempt, max_delay)
+
+
+def _post_bulk(
+    session: requests.Session,
+    bulk_url: str,
+    body: bytes,
+    stats: BulkUploadStats,
+    max_retries: int = 5,
+    backoff: float = BULK_RETRY_BACKOFF_SECONDS,
+    compress: bool = False,
+) -> None:
+    """
+    Sends one bulk request, gzip-compressed with compress. Overload responses
+    are retried with exponential backoff; items that failed for the same
+    reason are re-submitted on their own, any other item failure is counted
+    as rejected.
+    """
+    attempt = 0
+    headers = {"Content-Type": "application/json"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+
+    while True:
+        data = gzip.compress(body, compresslevel=BULK_GZIP_LEVEL) if compress else body
+        resp = session.post(
+            bulk_url,
+            headers=headers,
+            data=data,
+            timeout=120,
+        )
+        stats.add(nbytes=len(data))
+
+        if resp.status_code in BULK_RETRY_STATUSES and attempt < max_retries:
+            log.warning("Bulk request answered %d, retrying", resp.status_code)
+            time.sleep(_retry_delay(attempt, backoff))
+            attempt += 1
             continue
 
-        full_url = resolve(fhir_base_url, measure_url)
-        log.debug("Downloading report %s", full_url)
+        resp.raise_for_status()
+        result = resp.json()
+        items = result.get("items", [])
+
+        if not result.get("errors"):
+            stats.add(docs=len(items))
+            return
+
+        retry = []
+        n_ok = 0
+        n_rejected = 0
+        for action, item in zip(_split_bulk_actions(body), items):
+            # an item without an outcome is not acknowledged, count it as rejected
+            outcome = next(iter(item.values()), {})
+            status = outcome.get("status", 500)
+
+            if status < 300:
+                n_ok += 1
+            elif status in BULK_RETRY_STATUSES and attempt < max_retries:
+                retry.append(action)
+            else:
+                n_rejected += 1
+                if stats.should_log_error():
+                    log.error("Bulk item %s rejected with %d: %s", outcome.get("_id"), status, outcome.get("error"))
+
+        stats.add(docs=n_ok, rejected=n_rejected, retried=len(retry))
+
+        if not retry:
+            return
+
+        log.warning("Re-submitting %d of %d bulk items", len(retry), len(items))
+        body = b"".join(retry)
+        time.sleep(_retry_delay(attempt, backoff))
+        attempt += 1
+
+
+def upload_bulk_bodies(
+    session: requests.Session,
+    es_base_url: str,
+    es_index: str,
+    bodies: Iterable[bytes],
+    concurrency: int = 1,
+    max_retries: int = 5,
+    backoff: float = BULK_RETRY_BACKOFF_SECONDS,
+    compress: bool = False,
+) -> BulkUploadStats:
+    """
+    Sends bulk bodies as they are produced. At most 2 × concurrency bodies are
+    in flight; pulling the next one from `bodies` blocks until a slot frees
+    up, so a fast producer cannot buffer the whole update in memory.
+    """
+    bulk_url = f"{es_base_url}/{es_index}/_bulk"
+    stats = BulkUploadStats()
+    in_flight = threading.BoundedSemaphore(2 * max(1, concurrency))
+    failures = []
+
+    def upload(index: int, body: bytes) -> None:
+        try:
+            _post_bulk(session, bulk_url, body, stats, max_retries=max_retries, backoff=backoff, compress=compress)
+        except Exception as e:
+            # Any failure has to fail the update, or the snapshot would be
+            # saved without these nodes and they would never be resent.
+            log.error("Bulk request %d failed: %s", index, e)
+            failures.append(index)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for index, body in enumerate(bodies, start=1):
+            in_flight.acquire()
+            pool.submit(upload, index, body)
+
+    log.info("Bulk upload: %s", stats.summary())
+
+    if failures or stats.rejected:
+        raise RuntimeError(
+            f"Elasticsearch update incomplete: {len(failures)} failed requests, {stats.rejected} rejected documents"
+        )
 
-        report = session.get(full_url, allow_redirects=False, params={"_format": "json"}, timeout=(5, 60))
-        report.raise_for_status()
+    log.info("Elasticsearch update complete")
+    return stats
 
-        outfile = input_dir / f"availability_report_{author}.json"
-        outfile.write_text(json.dumps(report.json()), encoding="utf-8")
 
-    return len(docrefs)
+def _read_bulk_files(files: Iterable[Path]) -> Iterator[bytes]:
+    for file in files:
+        log.info("Uploading %s", file.name)
+        yield file.read_bytes()
 
 
 def update_availability_in_es(
@@ -197,24 +914,131 @@ def update_availability_in_es(
     es_base_url: str,
     es_index: str,
     availability_dir: Path,
-) -> None:
+    concurrency: int = 1,
+    max_retries: int = 5,
+    backoff: float = BULK_RETRY_BACKOFF_SECONDS,
+    compress: bool = False,
+) -> BulkUploadStats:
+
+    files = sorted(availability_dir.glob(f"{ElasticAvailabilityGenerator.UPDATE_FILE_PREFIX}_*.json"))
+
+    return upload_bulk_bodies(
+        session,
+        es_base_url,
+        es_index,
+        _read_bulk_files(files),
+        concurrency=concurrency,
+        max_retries=max_retries,
+        backoff=backoff,
+        compress=compress,
+    )
 
-    bulk_url = f"{es_base_url}/{es_index}/_bulk"
 
-    for file in sorted(availability_dir.glob("*.json")):
-        log.info("Uploading %s", file.name)
+def reset_availability_in_es(session: requests.Session, es_base_url: str, es_index: str) -> int:
+    """
+    Sets the availability of every node in es_index that is not 0 to 0, so
+    that a full update can leave out the nodes in bucket 0. Returns the
+    number of nodes reset, which is 0 for an index fresh from the ontology.
+    """
+    resp = session.post(
+        f"{es_base_url}/{es_index}/_update_by_query",
+        params={"conflicts": "proceed", "slices": "auto"},
+        json={
+            "query": {"bool": {"must_not": {"term": {"availability": 0}}}},
+            "script": {"source": "ctx._source.availability = 0", "lang": "painless"},
+        },
+        timeout=ES_RESET_TIMEOUT_SECONDS,
+    )
+    resp.raise_for_status()
+    result = resp.json()
 
-        with file.open("rb") as fh:
-            resp = session.post(
-                bulk_url,
-                headers={"Content-Type": "application/json"},
-                data=fh,
-                timeout=120,
-            )
+    if result.get("failures"):
+        raise RuntimeError(f"Resetting availability in {es_index} failed: {result['failures'][:MAX_LOGGED_BULK_ERRORS]}")
 
-        resp.raise_for_status()          
+    log.info("Reset availability of %d nodes in %s", result.get("updated", 0), es_index)
+    return result.get("updated", 0)
 
-    log.info("Elasticsearch update complete")
+
+def _copyable_settings(settings: dict) -> dict:
+    return {key: value for key, value in settings.items() if key not in ES_PRIVATE_INDEX_SETTINGS}
+
+
+def rebuild_index_blue_green(
+    session: requests.Session,
+    es_base_url: str,
+    alias: str,
+    bodies: Iterable[bytes],
+    concurrency: int = 1,
+    max_retries: int = 5,
+    backoff: float = BULK_RETRY_BACKOFF_SECONDS,
+    compress: bool = False,
+) -> str:
+    """
+    Loads bodies (bulk index actions, see ElasticAvailabilityGenerator.index_bodies)
+    into a new index with the mappings and settings of the index behind
+    alias, then moves alias and the other aliases of that index over to the
+    new one in a single, atomic request and deletes the old index. The new
+    index is loaded without replicas and refreshes, both are restored
+    before the swap. If alias is still a concrete index (as created by the
+    ontology import), it is replaced by the alias. Returns the new index.
+    """
+    resp = session.get(f"{es_base_url}/{alias}", timeout=60)
+    if resp.status_code == 404:
+        raise RuntimeError(f"Index {alias} not found, it is needed as template for the new index")
+    resp.raise_for_status()
+    old_indices = resp.json()
+
+    old_name, old = sorted(old_indices.items())[-1]
+    settings = _copyable_settings(old["settings"]["index"])
+    new_index = f"{alias}-{datetime.now(timezone.utc):%Y%m%d%H%M%S}"
+
+    log.info("Creating index %s from %s", new_index, old_name)
+    resp = session.put(
+        f"{es_base_url}/{new_index}",
+        json={
+            "settings": {"index": {**settings, "number_of_replicas": 0, "refresh_interval": "-1"}},
+            "mappings": old["mappings"],
+        },
+        timeout=60,
+    )
+    resp.raise_for_status()
+
+    try:
+        upload_bulk_bodies(session, es_base_url, new_index, bodies, concurrency=concurrency,
+                           max_retries=max_retries, backoff=backoff, compress=compress)
+
+        resp = session.put(
+            f"{es_base_url}/{new_index}/_settings",
+            json={"index": {
+                "number_of_replicas": settings.get("number_of_replicas", 1),
+                "refresh_interval": settings.get("refresh_interval"),
+            }},
+            timeout=60,
+        )
+        resp.raise_for_status()
+        session.post(f"{es_base_url}/{new_index}/_refresh", timeout=ES_RESET_TIMEOUT_SECONDS).raise_for_status()
+
+        actions = [{"add": {"index": new_index, "alias": name}} for name in sorted(old.get("aliases", {}))
+                   if name != alias]
+        actions.append({"add": {"index": new_index, "alias": alias}})
+        if alias in old_indices:
+            actions.append({"remove_index": {"index": alias}})
+        else:
+            actions.extend({"remove": {"index": name, "alias": alias}} for name in sorted(old_indices))
+        session.post(f"{es_base_url}/_aliases", json={"actions": actions}, timeout=60).raise_for_status()
+    except BaseException:
+        log.error("Deleting incomplete index %s, %s stays on %s", new_index, alias, ", ".join(sorted(old_indices)))
+        session.delete(f"{es_base_url}/{new_index}", timeout=60)
+        raise
+
+    log.info("Alias %s moved to %s", alias, new_index)
+
+    for name in sorted(old_indices):
+        if name != alias:
+            session.delete(f"{es_base_url}/{name}", timeout=60).raise_for_status()
+            log.info("Deleted index %s", name)
+
+    return new_index
 
 
 def parse_args() -> argparse.Namespace:
@@ -223,8 +1047,10 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--onto-repo", required=True)
     parser.add_argument("--onto-git-tag", required=True)
     parser.add_argument("--update-ontology", action="store_true")
+    parser.add_argument("--read-ontology-from-zip", action="store_true")
     parser.add_argument("--onto-repo-username")
     parser.add_argument("--onto-repo-password")
+    parser.add_argument("--onto-checksums", type=Path, default=None)
 
     parser.add_argument("--ontology-dir", required=True, type=Path)
     parser.add_argument("--availability-input-dir", required=True, type=Path)
@@ -236,6 +1062,29 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--es-base-url", required=True)
     parser.add_argument("--es-index", required=True)
     parser.add_argument("--min-n-reports", default=3, required=False, type=int)
+    parser.add_argument("--full-refresh", action="store_true")
+    parser.add_argument("--use-numpy", action="store_true")
+    parser.add_argument("--es-bulk-concurrency", default=2, type=int)
+    parser.add_argument("--es-bulk-max-retries", default=5, type=int)
+    parser.add_argument("--stream-es-updates", action="store_true")
+    parser.add_argument("--es-bulk-gzip", action="store_true")
+    parser.add_argument("--skip-zero-buckets", action="store_true")
+    parser.add_argument("--es-update-mode", default="update", choices=ES_UPDATE_MODES)
+    parser.add_argument("--metrics-textfile", type=Path, default=None)
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=None)
+    parser.add_argument("--profile-sample-rate", default=1.0, type=float)
+    parser.add_argument("--keep-update-files", action="store_true")
+    parser.add_argument("--report-fetch-concurrency", default=4, type=int)
+    parser.add_argument("--report-cache-dir", type=Path, default=None)
+    parser.add_argument("--disable-report-cache", action="store_true")
+    parser.add_argument("--ontology-index-dir", type=Path, default=None)
+    parser.add_argument("--disable-ontology-index", action="store_true")
+    parser.add_argument("--ontology-workers", default=1, type=int)
+    parser.add_argument("--json-backend", default="auto", choices=BACKENDS)
+    parser.add_argument("--stream-reports", action="store_true")
+    parser.add_argument("--report-workers", default=1, type=int)
+    parser.add_argument("--in-memory-reports", action="store_true")
+    parser.add_argument("--persist-reports", action="store_true")
 
     parser.add_argument(
         "--loglevel",
@@ -270,6 +1119,28 @@ def main() -> None:
     args.availability_input_dir.mkdir(parents=True, exist_ok=True)
     args.availability_output_dir.mkdir(parents=True, exist_ok=True)
 
+    profiler = None
+    # cProfile and tracemalloc slow a run down, so with a sample rate below 1
+    # only that share of the runs is profiled.
+    if args.profile and random.random() < args.profile_sample_rate:
+        profile_dir = args.availability_output_dir / PROFILE_DIR
+        log.info("Profiling this run (%s), writing profiles to %s", args.profile, profile_dir)
+        profiler = StageProfiler(profile_dir, args.profile)
+
+    metrics = RunMetrics(profiler=profiler)
+    try:
+        metrics.status = "succeeded" if run(args, metrics) else "skipped"
+    except BaseException:
+        metrics.status = "failed"
+        raise
+    finally:
+        metrics.write_summary(args.availability_output_dir / RUN_SUMMARY_FILE)
+        if args.metrics_textfile:
+            metrics.write_prometheus(args.metrics_textfile)
+
+
+def run(args: argparse.Namespace, metrics: RunMetrics) -> bool:
+    """Runs the update, recording every stage in metrics. Returns False if skipped for too few reports."""
     with requests.Session() as session:
 
         configure_session(
@@ -285,40 +1156,158 @@ def main() -> None:
             ca_cert_path=args.ca_cert
         )
 
+        # requests keeps at most 10 pooled connections per host by default;
+        # size the pool to the concurrency of report downloads and bulk
+        # uploads so parallel requests don't keep opening new connections.
+        adapter = HTTPAdapter(pool_maxsize=max(10, args.report_fetch_concurrency, args.es_bulk_concurrency))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
         if args.update_ontology:
             onto_repo_auth = build_onto_repo_auth(args.onto_repo_username, args.onto_repo_password)
+            checksums = read_checksums(args.onto_checksums) if args.onto_checksums else {}
 
             base = f"{args.onto_repo}/{args.onto_git_tag}"
-            download_and_unzip(session, f"{base}/elastic.zip", args.ontology_dir, auth=onto_repo_auth)
-            download_and_unzip(session, f"{base}/availability.zip", args.availability_input_dir, auth=onto_repo_auth)
+            manifest = ReleaseManifest(args.ontology_dir / ReleaseManifest.FILE)
+            with metrics.stage("ontology_download") as stage:
+                if args.read_ontology_from_zip:
+                    downloaded = update_release_archive(
+                        session, manifest, args.onto_git_tag, f"{base}/elastic.zip",
+                        args.ontology_dir / ElasticAvailabilityGenerator.ONTOLOGY_ARCHIVE,
+                        extract=False, auth=onto_repo_auth, sha256=checksums.get("elastic.zip"))
+                else:
+                    downloaded = update_release_archive(session, manifest, args.onto_git_tag, f"{base}/elastic.zip",
+                                                        args.ontology_dir, auth=onto_repo_auth,
+                                                        sha256=checksums.get("elastic.zip"))
+                downloaded += update_release_archive(session, manifest, args.onto_git_tag, f"{base}/availability.zip",
+                                                     args.availability_input_dir, auth=onto_repo_auth,
+                                                     sha256=checksums.get("availability.zip"))
+                stage.count("archives", downloaded)
+
+        ontology_index_dir = None
+        if not args.disable_ontology_index:
+            # Next to, not inside ontology_dir, which is wiped whenever
+            # elastic.zip is extracted.
+            ontology_index_dir = args.ontology_index_dir or args.ontology_dir.with_name(
+                f"{args.ontology_dir.name}_index"
+            )
 
-        n_reports = download_availability_reports(
-            session,
+        generator = ElasticAvailabilityGenerator(
             args.availability_input_dir,
-            args.availability_report_server_base_url,
-            args.availability_master_ident,
+            args.availability_output_dir,
+            args.ontology_dir,
+            ontology_tag=args.onto_git_tag,
+            full_refresh=args.full_refresh,
+            use_numpy=args.use_numpy,
+            ontology_index_dir=ontology_index_dir,
+            ontology_workers=args.ontology_workers,
+            json_backend=args.json_backend,
+            stream_reports=args.stream_reports,
+            report_workers=args.report_workers,
+            in_memory_reports=args.in_memory_reports,
+            skip_zero_buckets=args.skip_zero_buckets,
+            metrics=metrics,
         )
 
+        report_cache = None
+        if not args.disable_report_cache:
+            # Kept outside availability_input_dir, which is wiped whenever
+            # availability.zip is extracted.
+            cache_dir = args.report_cache_dir or args.availability_input_dir.with_name(
+                f"{args.availability_input_dir.name}_report_cache"
+            )
+            report_cache = ReportCache(cache_dir)
+
+        with metrics.stage("report_download") as stage:
+            if args.in_memory_reports:
+                # Reports are aggregated as they arrive instead of being read back
+                # from availability_input_dir; they are only written there for
+                # auditing with --persist-reports.
+                n_reports = download_availability_reports(
+                    session,
+                    args.availability_input_dir,
+                    args.availability_report_server_base_url,
+                    args.availability_master_ident,
+                    concurrency=args.report_fetch_concurrency,
+                    cache=report_cache,
+                    parse_report=generator.parse_report,
+                    on_report=generator.add_report_scores,
+                    keep_files=args.persist_reports,
+                )
+            else:
+                n_reports = download_availability_reports(
+                    session,
+                    args.availability_input_dir,
+                    args.availability_report_server_base_url,
+                    args.availability_master_ident,
+                    concurrency=args.report_fetch_concurrency,
+                    cache=report_cache,
+                )
+            stage.count("reports", n_reports)
+
         if n_reports < args.min_n_reports:
             log.info("Only %d reports found, but %d required → stopping", n_reports, args.min_n_reports)
-            return
+            return False
 
         log.info("Processing %d reports", n_reports)
 
-        generator = ElasticAvailabilityGenerator(
-            args.availability_input_dir,
-            args.availability_output_dir,
-            args.ontology_dir,
-        )
-
-        generator.generate()
-
-        update_availability_in_es(
-            session,
-            args.es_base_url,
-            args.es_index,
-            args.availability_output_dir,
-        )
+        # In blue-green and streaming mode, building the bulk bodies is part
+        # of the es_upload stage, as they are built while being uploaded.
+        if args.es_update_mode == "blue-green":
+            generator.prepare()
+
+            with metrics.stage("es_upload"):
+                generator.invalidate_snapshot()
+                rebuild_index_blue_green(
+                    session,
+                    args.es_base_url,
+                    args.es_index,
+                    generator.index_bodies(),
+                    concurrency=args.es_bulk_concurrency,
+                    max_retries=args.es_bulk_max_retries,
+                    compress=args.es_bulk_gzip,
+                )
+        elif args.stream_es_updates:
+            generator.prepare()
+
+            with metrics.stage("es_upload") as stage:
+                generator.invalidate_snapshot()
+                if generator.resets_index:
+                    reset_availability_in_es(session, args.es_base_url, args.es_index)
+
+                stats = upload_bulk_bodies(
+                    session,
+                    args.es_base_url,
+                    args.es_index,
+                    generator.bulk_bodies(keep_files=args.keep_update_files),
+                    concurrency=args.es_bulk_concurrency,
+                    max_retries=args.es_bulk_max_retries,
+                    compress=args.es_bulk_gzip,
+                )
+                stage.count("docs", stats.docs)
+                stage.count("bytes", stats.bytes)
+        else:
+            generator.generate()
+
+            with metrics.stage("es_upload") as stage:
+                generator.invalidate_snapshot()
+                if generator.resets_index:
+                    reset_availability_in_es(session, args.es_base_url, args.es_index)
+
+                stats = update_availability_in_es(
+                    session,
+                    args.es_base_url,
+                    args.es_index,
+                    args.availability_output_dir,
+                    concurrency=args.es_bulk_concurrency,
+                    max_retries=args.es_bulk_max_retries,
+                    compress=args.es_bulk_gzip,
+                )
+                stage.count("docs", stats.docs)
+                stage.count("bytes", stats.bytes)
+
+        generator.save_snapshot()
+        return True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+import json
+import logging
+from typing import Any, Callable, NamedTuple, Union
+
+try:
+    import orjson
+except ImportError:  # optional, see get_backend
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:  # optional, see get_backend
+    simdjson = None
+
+log = logging.getLogger(__name__)
+
+BACKENDS = ("auto", "stdlib", "orjson", "simdjson")
+
+
+class JsonBackend(NamedTuple):
+    """
+    JSON parser and serializer used on the hot paths (ontology export,
+    MeasureReports, bulk bodies). dumps() returns UTF-8 encoded JSON without
+    escaping non-ASCII characters. parse_documents tells whether parsing an
+    ontology document in full is faster than decoding just its children
+    with the stdlib decoder, see iter_ontology_nodes.
+    """
+    name: str
+    loads: Callable[[Union[bytes, str]], Any]
+    dumps: Callable[[Any], bytes]
+    parse_documents: bool = False
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+STDLIB = JsonBackend("stdlib", json.loads, _stdlib_dumps)
+
+
+def get_backend(name: str = "auto") -> JsonBackend:
+    """
+    Returns the JSON backend `name`. "auto" picks orjson if installed, else
+    the stdlib json module; simdjson is not measurably faster over the whole
+    run (see test/benchmark/benchmark_json_backends.py) and has to be chosen
+    explicitly. A backend that is not installed falls back to the stdlib
+    json module. simdjson only parses, serializing uses stdlib.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JSON backend '{name}', expected one of {', '.join(BACKENDS)}")
+
+    if name in ("auto", "orjson") and orjson is not None:
+        return JsonBackend("orjson", orjson.loads, orjson.dumps, parse_documents=True)
+    if name == "simdjson" and simdjson is not None:
+        return JsonBackend("simdjson", simdjson.loads, _stdlib_dumps)
+
+    if name not in ("auto", "stdlib"):
+        log.warning("%s is not installed, falling back to the stdlib json module", name)
+    return STDLIB
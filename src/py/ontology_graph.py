@@ -0,0 +1,494 @@
+import hashlib
+import json
+import logging
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from atomic_file import atomic_write
+
+try:
+    import numpy as np
+except ImportError:  # optional, only needed for rollup_numpy()
+    np = None
+
+log = logging.getLogger(__name__)
+
+_LOW_64_BITS = (1 << 64) - 1
+
+INDEX_MAGIC = b"ONTOIDX1"
+# Arrays persisted by OntologyGraph.save(), with their array typecodes.
+_INDEX_SECTIONS = (
+    ("_id_data", "B"),
+    ("_id_offsets", "q"),
+    ("_sorted_hi", "Q"),
+    ("_sorted_lo", "Q"),
+    ("_sorted_nodes", "i"),
+    ("offsets", "q"),
+    ("indices", "i"),
+)
+
+
+def node_key(node_hash: str) -> int:
+    """
+    128-bit lookup key of a node hash. Ontology node ids are UUIDs, whose
+    value is used directly; anything else is hashed with BLAKE2b.
+    """
+    if len(node_hash) == 36:
+        try:
+            return int(node_hash.replace("-", ""), 16)
+        except ValueError:
+            pass
+    return int.from_bytes(hashlib.blake2b(node_hash.encode("utf-8"), digest_size=16).digest(), "big")
+
+
+class OntologyGraph:
+    """
+    Compact, array-backed representation of the ontology hierarchy.
+
+    Nodes get dense integer ids in order of their first definition. Instead
+    of a dict and a string object per node, the node hashes are kept
+    UTF-8 encoded back to back in one buffer, and lookups by hash go through
+    a sorted array of 128-bit keys (see node_key). Children are stored in CSR
+    form, the children of node i being `indices[offsets[i]:offsets[i + 1]]`,
+    and the availability of all nodes lives in a single int64 array. This
+    costs well under 100 bytes per node and 4 bytes per edge.
+
+    Nodes are added with add_node() while the export is read; finalize()
+    then builds the lookup and CSR arrays. A node defined more than once
+    keeps its first position and the children of its last definition;
+    children that are referenced but never defined are dropped. A finalized
+    graph can be written to disk with save() and memory-mapped with load().
+    """
+
+    def __init__(self) -> None:
+        self._id_data = bytearray()
+        self._id_offsets = array("q", [0])
+
+        self._sorted_hi = array("Q")
+        self._sorted_lo = array("Q")
+        self._sorted_nodes = array("i")
+
+        self.offsets = array("q", [0])
+        self.indices = array("i")
+        self.availability = array("q")
+        self._mapped: Optional[mmap.mmap] = None
+
+        # Build state, one entry per add_node() call and per child reference.
+        self._definition_hi = array("Q")
+        self._definition_lo = array("Q")
+        self._edge_definitions = array("i")
+        self._edge_hi = array("Q")
+        self._edge_lo = array("Q")
+
+    def __len__(self) -> int:
+        return len(self._id_offsets) - 1
+
+    def node_id(self, node: int) -> str:
+        return str(self._id_data[self._id_offsets[node]:self._id_offsets[node + 1]], "utf-8")
+
+    def iter_ids(self) -> Iterator[str]:
+        data = self._id_data
+        offsets = self._id_offsets
+        for node in range(len(self)):
+            yield str(data[offsets[node]:offsets[node + 1]], "utf-8")
+
+    def add_node(self, node_hash: str, child_hashes: Iterable[str]) -> None:
+        definition = len(self._definition_hi)
+
+        key = node_key(node_hash)
+        self._definition_hi.append(key >> 64)
+        self._definition_lo.append(key & _LOW_64_BITS)
+        self._id_data += node_hash.encode("utf-8")
+        self._id_offsets.append(len(self._id_data))
+
+        edge_definitions = self._edge_definitions
+        edge_hi = self._edge_hi
+        edge_lo = self._edge_lo
+        for child_hash in child_hashes:
+            key = node_key(child_hash)
+            edge_definitions.append(definition)
+            edge_hi.append(key >> 64)
+            edge_lo.append(key & _LOW_64_BITS)
+
+    def merge(self, other: "OntologyGraph") -> None:
+        """
+        Appends the nodes added to another graph, which must not be finalized
+        yet, as if they had been added to this one after its own nodes. Used
+        to combine graphs built from parts of the export in parallel.
+        """
+        definition_shift = len(self._definition_hi)
+        data_shift = len(self._id_data)
+
+        self._id_data += other._id_data
+        self._id_offsets.extend(array("q", (offset + data_shift for offset in other._id_offsets[1:])))
+        self._definition_hi.extend(other._definition_hi)
+        self._definition_lo.extend(other._definition_lo)
+        self._edge_definitions.extend(array("i", (d + definition_shift for d in other._edge_definitions)))
+        self._edge_hi.extend(other._edge_hi)
+        self._edge_lo.extend(other._edge_lo)
+
+    def _find_key(self, hi: int, lo: int) -> Optional[int]:
+        sorted_hi = self._sorted_hi
+        i = bisect_left(sorted_hi, hi)
+        while i < len(sorted_hi) and sorted_hi[i] == hi:
+            if self._sorted_lo[i] == lo:
+                return self._sorted_nodes[i]
+            i += 1
+        return None
+
+    def find(self, node_hash: str) -> Optional[int]:
+        """Returns the id of the node with the given hash, or None if it is not in the ontology."""
+        key = node_key(node_hash)
+        return self._find_key(key >> 64, key & _LOW_64_BITS)
+
+    def _definitions_by_key(self) -> array:
+        """
+        The definitions ordered by key, stably. The keys are sorted without
+        creating an int object per definition: with np.lexsort if NumPy is
+        installed, otherwise as packed 20-byte records of key and definition.
+        """
+        n_definitions = len(self._definition_hi)
+        by_key = array("i")
+
+        if np is not None:
+            hi = np.frombuffer(self._definition_hi, dtype=np.uint64)
+            lo = np.frombuffer(self._definition_lo, dtype=np.uint64)
+            by_key.frombytes(np.lexsort((lo, hi)).astype(np.int32).tobytes())
+            # release the buffers, the arrays cannot be resized while exported
+            del hi, lo
+            return by_key
+
+        # Big-endian, so that the records compare like the keys; ties are
+        # broken by the definition, which keeps the order stable.
+        pack = struct.Struct(">QQI").pack
+        records = sorted(pack(hi, lo, definition) for definition, hi, lo
+                         in zip(range(n_definitions), self._definition_hi, self._definition_lo))
+        by_key.extend(int.from_bytes(record[16:], "big") for record in records)
+        return by_key
+
+    def _deduplicate(self) -> Tuple[array, array]:
+        """
+        Builds the sorted key lookup over the distinct nodes. Returns, for
+        every definition, its dense node id and whether its children count
+        (only those of the last definition of a node do).
+        """
+        def_hi = self._definition_hi
+        def_lo = self._definition_lo
+        n_definitions = len(def_hi)
+
+        by_key = self._definitions_by_key()
+
+        # Stable sort: within a run of equal keys the first entry is the
+        # first definition, the last entry the last one.
+        first_definition = array("i", [-1]) * n_definitions
+        last_definition = array("i", [-1]) * n_definitions
+        run_start = 0
+        for i in range(1, n_definitions + 1):
+            if (i == n_definitions or def_lo[by_key[i]] != def_lo[by_key[run_start]]
+                    or def_hi[by_key[i]] != def_hi[by_key[run_start]]):
+                first = by_key[run_start]
+                if i - run_start > 1:
+                    log.debug("Ontology node %s is defined %d times, using its last definition",
+                              self.node_id(first), i - run_start)
+                for j in range(run_start, i):
+                    first_definition[by_key[j]] = first
+                last_definition[first] = by_key[i - 1]
+                run_start = i
+
+        node_of_definition = array("i", [-1]) * n_definitions
+        n_nodes = 0
+        for definition in range(n_definitions):
+            first = first_definition[definition]
+            if first == definition:
+                node_of_definition[definition] = n_nodes
+                n_nodes += 1
+            else:
+                node_of_definition[definition] = node_of_definition[first]
+
+        for definition in by_key:
+            if first_definition[definition] == definition:
+                self._sorted_hi.append(def_hi[definition])
+                self._sorted_lo.append(def_lo[definition])
+                self._sorted_nodes.append(node_of_definition[definition])
+
+        has_edges = bytearray(n_definitions)
+        for definition in range(n_definitions):
+            if last_definition[definition] >= 0:
+                has_edges[last_definition[definition]] = 1
+
+        if n_nodes != n_definitions:
+            id_data = bytearray()
+            id_offsets = array("q", [0])
+            for definition in range(n_definitions):
+                if first_definition[definition] == definition:
+                    id_data += self._id_data[self._id_offsets[definition]:self._id_offsets[definition + 1]]
+                    id_offsets.append(len(id_data))
+            self._id_data = id_data
+            self._id_offsets = id_offsets
+
+        return node_of_definition, has_edges
+
+    def finalize(self) -> None:
+        """Builds the key lookup and the CSR child arrays from the added nodes."""
+        node_of_definition, has_edges = self._deduplicate()
+        n = len(self)
+
+        counts = array("q", [0]) * (n + 1)
+        edge_parents = array("i")
+        edge_children = array("i")
+        n_missing = 0
+
+        find_key = self._find_key
+        for definition, hi, lo in zip(self._edge_definitions, self._edge_hi, self._edge_lo):
+            if not has_edges[definition]:
+                continue
+            child = find_key(hi, lo)
+            if child is None:
+                n_missing += 1
+                continue
+            parent = node_of_definition[definition]
+            edge_parents.append(parent)
+            edge_children.append(child)
+            counts[parent + 1] += 1
+
+        # The build state is no longer needed; freeing it here lowers the
+        # peak of the build, which is reached while the CSR arrays are filled.
+        self._definition_hi = array("Q")
+        self._definition_lo = array("Q")
+        self._edge_definitions = array("i")
+        self._edge_hi = array("Q")
+        self._edge_lo = array("Q")
+
+        for i in range(n):
+            counts[i + 1] += counts[i]
+
+        # counts now holds the CSR offsets; fill the children stably so each
+        # node keeps the order of its children from the export.
+        position = array("q", counts)
+        indices = array("i", [0]) * len(edge_children)
+        for parent, child in zip(edge_parents, edge_children):
+            indices[position[parent]] = child
+            position[parent] += 1
+
+        self.offsets = counts
+        self.indices = indices
+        self.availability = array("q", [0]) * n
+
+        if n_missing:
+            log.info("Dropped %d references to children missing from the ontology", n_missing)
+
+    def save(self, path: Path, key: str) -> None:
+        """
+        Writes the finalized graph to a binary index file that load() can
+        memory-map. `key` identifies the ontology release the graph was built
+        from; load() only accepts the file for the same key.
+
+        The file is the magic, the length of a JSON header, the header and
+        the raw arrays, each starting at a multiple of 8 bytes.
+        """
+        sections = []
+        position = 0
+        for name, typecode in _INDEX_SECTIONS:
+            size = len(memoryview(getattr(self, name)).cast("B"))
+            sections.append([name, typecode, position, size])
+            position += -(-size // 8) * 8
+
+        header = json.dumps({"key": key, "byteorder": sys.byteorder, "sections": sections}).encode("utf-8")
+        header += b" " * (-len(header) % 8)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(path) as fh:
+            fh.write(INDEX_MAGIC)
+            fh.write(struct.pack("<Q", len(header)))
+            fh.write(header)
+            for name, _, _, size in sections:
+                fh.write(memoryview(getattr(self, name)).cast("B"))
+                fh.write(b"\0" * (-size % 8))
+
+    @classmethod
+    def load(cls, path: Path, key: str) -> Optional["OntologyGraph"]:
+        """
+        Memory-maps an index file written by save(). The arrays are used in
+        place, so only the pages actually touched are read from disk. Returns
+        None if the file is missing, unreadable or was built for another key.
+        """
+        try:
+            with path.open("rb") as fh:
+                mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        view = memoryview(mapped)
+        try:
+            if view[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+                raise ValueError("bad magic")
+            (header_size,) = struct.unpack_from("<Q", mapped, len(INDEX_MAGIC))
+            data_start = len(INDEX_MAGIC) + 8 + header_size
+            header = json.loads(bytes(view[len(INDEX_MAGIC) + 8:data_start]))
+            if header["key"] != key or header["byteorder"] != sys.byteorder:
+                log.info("Ontology index %s was built for another ontology release", path)
+                return None
+
+            graph = cls()
+            for name, typecode, offset, size in header["sections"]:
+                start = data_start + offset
+                if start + size > len(view):
+                    raise ValueError(f"section {name} is truncated")
+                setattr(graph, name, view[start:start + size].cast(typecode))
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            log.warning("Ignoring unreadable ontology index %s: %s", path, e)
+            return None
+
+        graph.availability = array("q", [0]) * len(graph)
+        # The views above point into the mapping, which has to stay open.
+        graph._mapped = mapped
+        return graph
+
+    def children(self, node: int) -> array:
+        return self.indices[self.offsets[node]:self.offsets[node + 1]]
+
+    def rollup(self) -> array:
+        """
+        Returns the availability of every node summed up with that of all its
+        descendants, in a single depth-first pass over the graph.
+
+        The traversal uses an explicit stack, so the depth of the hierarchy is
+        not limited by Python's recursion limit, and each node's total is
+        computed exactly once, when its last child is done (post-order).
+        Children that close a cycle are still on the current path at that
+        point and therefore have no total yet; they are skipped and reported.
+        """
+        totals = array("q", self.availability)
+        # 0 = not visited, 1 = on the current path, 2 = done
+        state = bytearray(len(self))
+
+        self._rollup_dfs(totals, state)
+        return totals
+
+    def _rollup_dfs(self, totals, state: bytearray) -> None:
+        """Rolls up all nodes not yet done in `state` into `totals`, see rollup()."""
+        offsets = self.offsets
+        indices = self.indices
+        cycle_edges: List[Tuple[int, int]] = []
+
+        for root in range(len(self)):
+            if state[root]:
+                continue
+
+            if offsets[root] == offsets[root + 1]:
+                state[root] = 2
+                continue
+
+            state[root] = 1
+            stack = [root]
+            positions = [offsets[root]]
+
+            while stack:
+                node = stack[-1]
+                position = positions[-1]
+                end = offsets[node + 1]
+                descended = False
+
+                while position < end:
+                    child = indices[position]
+                    position += 1
+
+                    child_state = state[child]
+                    if child_state == 2:
+                        continue
+                    if child_state == 1:
+                        cycle_edges.append((node, child))
+                        continue
+                    if offsets[child] == offsets[child + 1]:
+                        state[child] = 2
+                        continue
+
+                    positions[-1] = position
+                    state[child] = 1
+                    stack.append(child)
+                    positions.append(offsets[child])
+                    descended = True
+                    break
+
+                if descended:
+                    continue
+
+                stack.pop()
+                positions.pop()
+
+                total = totals[node]
+                for child in indices[offsets[node]:end]:
+                    if state[child] == 2:
+                        total += totals[child]
+                totals[node] = total
+                state[node] = 2
+
+        if cycle_edges:
+            log.warning("Ontology contains %d cycle edge(s), ignoring them in the availability roll-up",
+                        len(cycle_edges))
+            for parent, child in cycle_edges:
+                log.debug("Cycle detected: child %s of %s is one of its ancestors",
+                          self.node_id(child), self.node_id(parent))
+
+    def rollup_numpy(self) -> array:
+        """
+        Same result as rollup(), computed level by level with NumPy.
+
+        Nodes are peeled off bottom-up: leaves form level 0, and a node gets
+        the level after that of its last remaining child. Each level is then
+        aggregated with a single scatter-add over its child->parent edges.
+        Nodes from which a cycle is reachable never run out of children and
+        are left to the depth-first pass, which treats the already peeled
+        nodes as done; which cycle edge is dropped depends on the traversal
+        order, so this keeps the result identical to rollup().
+        """
+        n = len(self)
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        children = np.frombuffer(self.indices, dtype=np.int32)
+        out_degree = np.diff(offsets)
+        parents = np.repeat(np.arange(n, dtype=np.int32), out_degree)
+
+        # Edges grouped by child, to find the parents of a level's nodes.
+        by_child = np.argsort(children, kind="stable")
+        child_offsets = np.searchsorted(children[by_child], np.arange(n + 1))
+
+        remaining = out_degree.copy()
+        level = np.full(n, -1, dtype=np.int32)
+        frontier = np.flatnonzero(remaining == 0)
+        depth = 0
+
+        while frontier.size:
+            level[frontier] = depth
+
+            starts = child_offsets[frontier]
+            lengths = child_offsets[frontier + 1] - starts
+            run_starts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+            edges = by_child[run_starts + np.arange(lengths.sum())]
+
+            decrements = np.bincount(parents[edges], minlength=n)
+            remaining -= decrements
+            frontier = np.flatnonzero((decrements > 0) & (remaining == 0))
+            depth += 1
+
+        totals = np.frombuffer(self.availability, dtype=np.int64).copy()
+
+        edge_levels = level[parents]
+        by_level = np.argsort(edge_levels, kind="stable")
+        level_starts = np.searchsorted(edge_levels[by_level], np.arange(depth + 1))
+        for current in range(1, depth):
+            edges = by_level[level_starts[current]:level_starts[current + 1]]
+            np.add.at(totals, parents[edges], totals[children[edges]])
+
+        result = array("q")
+        result.frombytes(totals.tobytes())
+
+        if (level < 0).any():
+            state = bytearray((level >= 0).astype(np.uint8) * 2)
+            self._rollup_dfs(result, state)
+
+        return result
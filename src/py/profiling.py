@@ -0,0 +1,77 @@
+import cProfile
+import logging
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+log = logging.getLogger(__name__)
+
+PROFILE_MODES = ("cpu", "memory", "all")
+# Frames kept per allocation; every additional frame makes tracing slower.
+TRACEMALLOC_FRAMES = 1
+TOP_ALLOCATIONS = 25
+
+
+class StageProfiler:
+    """
+    Profiles every pipeline stage (see RunMetrics.stage) and writes the
+    results to profile_dir: with "cpu", a cProfile `<stage>.pstats` of the
+    thread running the stage (not of download threads or worker processes),
+    with "memory", `<stage>.allocations.txt` listing the lines that allocated
+    the most memory during the stage and the peak of traced memory. A stage
+    opened inside another one (e.g. rollup while streaming to ES) is part of
+    the outer stage's profile, as only one cProfile can be active at a time.
+    """
+
+    def __init__(self, profile_dir: Path, mode: str = "all", top: int = TOP_ALLOCATIONS) -> None:
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}', expected one of {', '.join(PROFILE_MODES)}")
+        self.profile_dir = Path(profile_dir)
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        self.cpu = mode in ("cpu", "all")
+        self.memory = mode in ("memory", "all")
+        self.top = top
+        self._depth = 0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+
+        before = None
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+
+        profiler = cProfile.Profile() if self.cpu else None
+        if profiler is not None:
+            profiler.enable()
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_dir / f"{name}.pstats")
+            if before is not None:
+                self._write_allocations(name, before)
+
+    def _write_allocations(self, name: str, before: tracemalloc.Snapshot) -> None:
+        peak = tracemalloc.get_traced_memory()[1]
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        after = tracemalloc.take_snapshot().filter_traces(ignore)
+        stats = after.compare_to(before.filter_traces(ignore), "lineno")
+
+        lines = [f"Stage {name}: peak traced memory {peak / 1024 / 1024:.1f} MB",
+                 f"Top {self.top} lines by memory allocated during the stage and still held at its end:"]
+        lines.extend(str(stat) for stat in stats[:self.top])
+        (self.profile_dir / f"{name}.allocations.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
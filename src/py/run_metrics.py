@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is reported as 0
+    resource = None
+
+from atomic_file import write_atomic
+
+log = logging.getLogger(__name__)
+
+METRIC_PREFIX = "availability_updater"
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process and of its largest finished child process (e.g. a worker)."""
+    if resource is None:
+        return 0
+    # ru_maxrss is in KiB on Linux, in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def cpu_seconds() -> float:
+    """CPU time of this process and its finished child processes."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class StageMetrics:
+    """Wall time, CPU time, peak RSS and item counts (e.g. nodes, reports) of a pipeline stage."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = 0
+        self.items: Dict[str, int] = {}
+
+    def count(self, item: str, n: int) -> None:
+        self.items[item] = self.items.get(item, 0) + n
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "items": dict(self.items),
+        }
+
+
+class RunMetrics:
+    """
+    Collects StageMetrics of every stage of a run, in the order the stages
+    first ran; a stage that runs several times is summed up. The peak RSS of
+    a stage is the peak of the process up to its end, as the OS keeps no
+    per-stage peak. With a profiler (see profiling.StageProfiler), every
+    stage is profiled as well.
+    """
+
+    def __init__(self, profiler: Optional[Any] = None) -> None:
+        self.profiler = profiler
+        self.started = datetime.now(timezone.utc)
+        self._started_wall = time.perf_counter()
+        self.stages: Dict[str, StageMetrics] = {}
+        self.status = "running"
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        metrics = self.stages.setdefault(name, StageMetrics(name))
+        profile = self.profiler.stage(name) if self.profiler is not None else nullcontext()
+        wall, cpu = time.perf_counter(), cpu_seconds()
+        try:
+            with profile:
+                yield metrics
+        finally:
+            metrics.wall_seconds += time.perf_counter() - wall
+            metrics.cpu_seconds += cpu_seconds() - cpu
+            metrics.peak_rss_bytes = peak_rss_bytes()
+            log.info("Stage %s took %.1fs (%.1fs CPU), peak RSS %.0f MB%s", name, metrics.wall_seconds,
+                     metrics.cpu_seconds, metrics.peak_rss_bytes / 1024 / 1024,
+                     "".join(f", {n} {item}" for item, n in metrics.items.items()))
+
+    def summary(self) -> dict:
+        return {
+            "started": self.started.isoformat(),
+            "duration_seconds": round(time.perf_counter() - self._started_wall, 3),
+            "status": self.status,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "stages": [stage.to_dict() for stage in self.stages.values()],
+        }
+
+    def write_summary(self, path: Path) -> None:
+        write_atomic(path, (json.dumps(self.summary(), indent=2) + "\n").encode("utf-8"))
+
+    def prometheus_text(self) -> str:
+        """The run in the Prometheus text exposition format, as read by the node_exporter textfile collector."""
+        summary = self.summary()
+        lines: List[str] = []
+
+        def metric(name: str, help_text: str, samples: List[tuple]) -> None:
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{_escape_label(str(v))}"' for key, v in labels.items())
+                lines.append(f"{METRIC_PREFIX}_{name}{{{label_text}}} {value}" if labels
+                             else f"{METRIC_PREFIX}_{name} {value}")
+
+        stages = summary["stages"]
+        metric("stage_wall_seconds", "Wall time of a pipeline stage.",
+               [({"stage": s["name"]}, s["wall_seconds"]) for s in stages])
+        metric("stage_cpu_seconds", "CPU time of a pipeline stage, including worker processes.",
+               [({"stage": s["name"]}, s["cpu_seconds"]) for s in stages])
+        metric("stage_peak_rss_bytes", "Peak resident set size up to the end of a pipeline stage.",
+               [({"stage": s["name"]}, s["peak_rss_bytes"]) for s in stages])
+        metric("stage_items", "Items processed by a pipeline stage.",
+               [({"stage": s["name"], "item": item}, n) for s in stages for item, n in s["items"].items()])
+        metric("run_timestamp_seconds", "Start of the last run.", [({}, int(self.started.timestamp()))])
+        metric("run_duration_seconds", "Duration of the last run.", [({}, summary["duration_seconds"])])
+        metric("run_success", "Whether the last run succeeded (skipped for too few reports counts as success).",
+               [({}, int(self.status in ("succeeded", "skipped")))])
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path) -> None:
+        # The textfile collector may read the file at any time.
+        write_atomic(path, self.prometheus_text().encode("utf-8"))
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
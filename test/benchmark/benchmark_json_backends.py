@@ -0,0 +1,75 @@
+"""
+Runs the availability generation end to end (ontology load, report
+aggregation, roll-up and writing the bulk update files) on a synthetic
+ontology export with every installed JSON backend.
+
+    python test/benchmark/benchmark_json_backends.py --nodes 300000 --reports 20
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import json_backend
+from elastic_availability_generator import ElasticAvailabilityGenerator
+from synthetic import make_tree, write_ontology, write_reports
+
+
+def run(name: str, input_dir: Path, ontology_dir: Path, output_dir: Path) -> dict:
+    gen = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, json_backend=name)
+    timings = {}
+
+    start = time.perf_counter()
+    gen.load_ontology_tree()
+    timings["ontology"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    gen.update_from_reports()
+    timings["reports"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    gen._write_chunked(gen._build_updates(gen._rollup()), gen.UPDATE_FILE_PREFIX)
+    timings["updates"] = time.perf_counter() - start
+
+    timings["total"] = sum(timings.values())
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=100_000)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--reports", type=int, default=10)
+    parser.add_argument("--stratum-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    backends = ["stdlib"]
+    backends += [name for name in ("orjson", "simdjson") if getattr(json_backend, name) is not None]
+
+    work_dir = Path(tempfile.mkdtemp(prefix="benchmark-json-"))
+    try:
+        input_dir, ontology_dir = work_dir / "input", work_dir / "ontology"
+        input_dir.mkdir()
+        write_ontology(ontology_dir, make_tree(args.nodes, args.fanout, seed=args.seed))
+        write_reports(input_dir, args.nodes, args.reports, args.stratum_ratio, args.seed)
+
+        results = {name: run(name, input_dir, ontology_dir, work_dir / f"output-{name}") for name in backends}
+    finally:
+        shutil.rmtree(work_dir)
+
+    baseline = results["stdlib"]["total"]
+    print(f"nodes: {args.nodes}, reports: {args.reports}")
+    print(f"{'backend':<10}{'ontology':>10}{'reports':>10}{'updates':>10}{'total':>10}")
+    for name, timings in results.items():
+        print(f"{name:<10}" + "".join(f"{timings[stage]:>9.2f}s" for stage in ("ontology", "reports", "updates", "total"))
+              + f" ({baseline / timings['total']:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Runs the whole availability update (ontology load, report aggregation,
+roll-up, writing the update files and the bulk upload) on a synthetic
+ontology and reports, uploading to a local stub Elasticsearch. Prints wall
+time, CPU time, peak RSS and peak Python allocations of every stage.
+
+    python test/benchmark/benchmark_pipeline.py --nodes 700000 --reports 20 --summary summary.json
+"""
+import argparse
+import gzip
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from elastic_availability_generator import ElasticAvailabilityGenerator
+from generate_availability import update_availability_in_es
+from run_metrics import RunMetrics
+from synthetic import make_tree, write_ontology, write_reports
+
+
+class StubElasticHandler(BaseHTTPRequestHandler):
+    """Accepts every bulk request and answers each of its actions with success."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        n_actions = sum(1 for line in body.splitlines() if line.strip()) // 2
+        payload = json.dumps({"errors": False, "items": [{"update": {"status": 200}}] * n_actions}).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class TracedMetrics(RunMetrics):
+    """RunMetrics that also records the peak of Python allocations of every stage with tracemalloc."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.traced_peaks = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        tracemalloc.reset_peak()
+        with super().stage(name) as stage:
+            try:
+                yield stage
+            finally:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.traced_peaks[name] = max(self.traced_peaks.get(name, 0), peak)
+
+
+def run(args, work_dir: Path, es_url: str, metrics: RunMetrics) -> None:
+    input_dir, output_dir, ontology_dir = work_dir / "input", work_dir / "output", work_dir / "ontology"
+
+    gen = ElasticAvailabilityGenerator(
+        input_dir, output_dir, ontology_dir,
+        ontology_tag="benchmark",
+        use_numpy=args.use_numpy,
+        ontology_workers=args.ontology_workers,
+        json_backend=args.json_backend,
+        report_workers=args.report_workers,
+        metrics=metrics,
+    )
+    gen.generate()
+
+    with requests.Session() as session, metrics.stage("es_upload") as stage:
+        stats = update_availability_in_es(session, es_url, "ontology", output_dir,
+                                          concurrency=args.es_bulk_concurrency, compress=args.es_bulk_gzip)
+        stage.count("docs", stats.docs)
+        stage.count("bytes", stats.bytes)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=100_000)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--shared-ratio", type=float, default=0.05)
+    parser.add_argument("--cycles", type=int, default=10)
+    parser.add_argument("--reports", type=int, default=10)
+    parser.add_argument("--stratum-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--use-numpy", action="store_true")
+    parser.add_argument("--ontology-workers", type=int, default=1)
+    parser.add_argument("--report-workers", type=int, default=1)
+    parser.add_argument("--json-backend", default="auto")
+    parser.add_argument("--es-bulk-concurrency", type=int, default=2)
+    parser.add_argument("--es-bulk-gzip", action="store_true")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also record peak Python allocations per stage (slows the run down considerably)")
+    parser.add_argument("--summary", type=Path, help="write the run summary as JSON to this file")
+    args = parser.parse_args()
+
+    es = ThreadingHTTPServer(("127.0.0.1", 0), StubElasticHandler)
+    threading.Thread(target=es.serve_forever, daemon=True).start()
+
+    work_dir = Path(tempfile.mkdtemp(prefix="benchmark-pipeline-"))
+    try:
+        (work_dir / "input").mkdir()
+        write_ontology(work_dir / "ontology",
+                       make_tree(args.nodes, args.fanout, args.shared_ratio, args.cycles, args.seed))
+        write_reports(work_dir / "input", args.nodes, args.reports, args.stratum_ratio, args.seed)
+
+        metrics = TracedMetrics() if args.tracemalloc else RunMetrics()
+        if args.tracemalloc:
+            tracemalloc.start()
+        run(args, work_dir, f"http://127.0.0.1:{es.server_port}", metrics)
+        metrics.status = "succeeded"
+    finally:
+        tracemalloc.stop()
+        es.shutdown()
+        shutil.rmtree(work_dir)
+
+    summary = metrics.summary()
+    summary["parameters"] = {key: value for key, value in vars(args).items() if key != "summary"}
+    traced_peaks = getattr(metrics, "traced_peaks", {})
+
+    mb = 1024 * 1024
+    print(f"nodes: {args.nodes}, reports: {args.reports}")
+    print(f"{'stage':<20}{'wall':>9}{'cpu':>9}{'rss':>10}{'traced':>10}  items")
+    for stage in summary["stages"]:
+        traced = traced_peaks.get(stage["name"])
+        stage["traced_peak_bytes"] = traced
+        print(f"{stage['name']:<20}{stage['wall_seconds']:>8.2f}s{stage['cpu_seconds']:>8.2f}s"
+              f"{stage['peak_rss_bytes'] / mb:>8.0f}MB" + (f"{traced / mb:>8.0f}MB" if traced is not None else f"{'-':>10}")
+              + "  " + ", ".join(f"{n} {item}" for item, n in stage["items"].items()))
+    print(f"{'total':<20}{summary['duration_seconds']:>8.2f}s")
+
+    if args.summary:
+        args.summary.write_text(json.dumps(summary, indent=2) + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Compares the array-backed OntologyGraph and its iterative availability
+roll-up with the dict-based recursive implementation it replaced, on a
+synthetic ontology graph.
+
+    python test/benchmark/benchmark_rollup.py --nodes 700000
+"""
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
+
+import ontology_graph
+from ontology_graph import OntologyGraph
+
+
+def make_tree(n_nodes: int, fanout: int, shared_ratio: float, seed: int):
+    """Children (as node numbers) of a tree of n_nodes with the given fan-out,
+    where a share of the children is additionally linked from a second parent."""
+    rng = random.Random(seed)
+    children = [[] for _ in range(n_nodes)]
+
+    for i in range(1, n_nodes):
+        parent = (i - 1) // fanout
+        children[parent].append(i)
+        if rng.random() < shared_ratio:
+            children[rng.randrange(0, parent + 1)].append(i)
+
+    scores = [rng.choice((0, 0, 0, 1, 10, 250)) for _ in range(n_nodes)]
+    return children, scores
+
+
+def node_hash(i: int) -> str:
+    return f"{i:08d}-0000-3000-8000-000000000000"
+
+
+def build_dicts(tree, scores):
+    """The availability/children dicts of the previous loader, ids interned."""
+    availability, children = {}, {}
+    for i, child_numbers in enumerate(tree):
+        node_id = sys.intern(node_hash(i))
+        availability[node_id] = scores[i]
+        children[node_id] = [sys.intern(node_hash(c)) for c in child_numbers] or None
+    return availability, children
+
+
+def build_graph(tree, scores) -> OntologyGraph:
+    graph = OntologyGraph()
+    for i, child_numbers in enumerate(tree):
+        graph.add_node(node_hash(i), [node_hash(c) for c in child_numbers])
+    graph.finalize()
+    for i, score in enumerate(scores):
+        graph.availability[i] = score
+    return graph
+
+
+def recursive_rollup(availability, children):
+    """The recursive implementation the iterative roll-up replaced."""
+    cache = {}
+
+    def accumulate(node_id, in_progress=None):
+        if node_id in cache:
+            return cache[node_id]
+        if in_progress is None:
+            in_progress = set()
+        total = availability[node_id]
+        in_progress.add(node_id)
+        for child_id in children[node_id] or ():
+            if child_id not in availability or child_id in in_progress:
+                continue
+            total += accumulate(child_id, in_progress)
+        in_progress.discard(node_id)
+        cache[node_id] = total
+        return total
+
+    return {node_id: accumulate(node_id) for node_id in availability}
+
+
+def measure(build, *args):
+    """Returns the result of build and the memory it retains and peaks at."""
+    tracemalloc.start()
+    result = build(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=200_000)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--shared-ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    tree, scores = make_tree(args.nodes, args.fanout, args.shared_ratio, args.seed)
+
+    (availability, children), dict_bytes, dict_peak = measure(build_dicts, tree, scores)
+    graph, graph_bytes, graph_peak = measure(build_graph, tree, scores)
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), args.nodes + 1000))
+
+    start = time.perf_counter()
+    expected = recursive_rollup(availability, children)
+    recursive_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    totals = graph.rollup()
+    iterative_s = time.perf_counter() - start
+
+    assert dict(zip(graph.iter_ids(), totals)) == expected, "iterative roll-up differs from the recursive one"
+
+    numpy_s = None
+    if ontology_graph.np is not None:
+        start = time.perf_counter()
+        numpy_totals = graph.rollup_numpy()
+        numpy_s = time.perf_counter() - start
+        assert numpy_totals == totals, "NumPy roll-up differs from the iterative one"
+
+    mb = 1024 * 1024
+    print(f"nodes:     {args.nodes}")
+    print(f"dicts:     {dict_bytes / mb:.1f} MB retained, {dict_peak / mb:.1f} MB peak")
+    print(f"graph:     {graph_bytes / mb:.1f} MB retained, {graph_peak / mb:.1f} MB peak")
+    print(f"recursive: {recursive_s:.2f}s")
+    print(f"iterative: {iterative_s:.2f}s ({recursive_s / iterative_s:.2f}x)")
+    if numpy_s is not None:
+        print(f"numpy:     {numpy_s:.2f}s ({recursive_s / numpy_s:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Synthetic ontology exports and MeasureReports for the benchmarks, shaped like
+the real ones: every node is a Diagnose code in CONTEXT, reports stratify by
+these codes.
+"""
+import json
+import random
+import sys
+import uuid
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
+
+from elastic_availability_generator import ElasticAvailabilityGenerator, termcode_key
+
+CONTEXT = {"system": "fdpg.mii.cds", "code": "Diagnose", "version": "1.0.0"}
+CODE_SYSTEM = "http://fhir.de/CodeSystem/bfarm/icd-10-gm"
+
+
+def code(i: int) -> str:
+    return f"C{i:07d}"
+
+
+def node_hash(i: int) -> str:
+    termcode = {"system": CODE_SYSTEM, "code": code(i)}
+    return str(uuid.uuid3(ElasticAvailabilityGenerator.NAMESPACE_UUID, termcode_key(CONTEXT, termcode)))
+
+
+def make_tree(n_nodes: int, fanout: int, shared_ratio: float = 0.0, n_cycles: int = 0,
+              seed: int = 42) -> List[List[int]]:
+    """
+    Children (as node numbers) of every node. Parents are picked around
+    (i - 1) // fanout, so fan-out and depth vary from node to node. A share
+    of the nodes is additionally linked from a second parent, and n_cycles
+    nodes get one of their ancestors as a child.
+    """
+    rng = random.Random(seed)
+    children: List[List[int]] = [[] for _ in range(n_nodes)]
+    parents = [-1] * n_nodes
+
+    for i in range(1, n_nodes):
+        parent = (i - 1) // fanout
+        parent = rng.randrange(max(0, parent - fanout), parent + 1)
+        children[parent].append(i)
+        parents[i] = parent
+        if rng.random() < shared_ratio:
+            other = rng.randrange(0, i)
+            if other != parent:
+                children[other].append(i)
+
+    for _ in range(n_cycles if n_nodes > 1 else 0):
+        node = rng.randrange(1, n_nodes)
+        ancestor = parents[node]
+        while parents[ancestor] >= 0 and rng.random() < 0.5:
+            ancestor = parents[ancestor]
+        children[node].append(ancestor)
+
+    return children
+
+
+def write_ontology(ontology_dir: Path, tree: List[List[int]]) -> None:
+    """An export shaped like the real one: display texts and translations make up most of each document."""
+    hashes = [node_hash(i) for i in range(len(tree))]
+    elastic_dir = ontology_dir / "elastic"
+    elastic_dir.mkdir(parents=True)
+    with (elastic_dir / "onto_es__ontology_1.json").open("w", encoding="utf-8") as fh:
+        for i, child_numbers in enumerate(tree):
+            fh.write(json.dumps({"index": {"_index": "ontology", "_id": hashes[i]}}) + "\n")
+            fh.write(json.dumps({
+                "name": f"Diagnose {code(i)}",
+                "availability": 0,
+                "terminology": CODE_SYSTEM,
+                "termcode": code(i),
+                "kds_module": "Diagnose",
+                "context": CONTEXT,
+                "display": {
+                    "original": f"Krankheit Nummer {i} mit längerer Beschreibung",
+                    "translations": [
+                        {"language": "de-DE", "value": f"Krankheit Nummer {i} mit längerer Beschreibung"},
+                        {"language": "en-US", "value": f"Disease number {i} with a longer description"},
+                    ],
+                },
+                "parents": [],
+                "children": [
+                    {
+                        "contextualized_termcode_hash": hashes[c],
+                        "display": {"original": f"Krankheit Nummer {c}", "translations": []},
+                        "terminology": CODE_SYSTEM,
+                        "termcode": code(c),
+                    }
+                    for c in child_numbers
+                ],
+                "related_terms": [],
+            }) + "\n")
+
+
+def write_reports(input_dir: Path, n_nodes: int, n_reports: int, stratum_ratio: float, seed: int = 42) -> None:
+    """One MeasureReport per site with a stratum for about stratum_ratio of the codes."""
+    rng = random.Random(seed)
+    (input_dir / "stratum-to-context.json").write_text(json.dumps({"cond": CONTEXT}), encoding="utf-8")
+    for site in range(n_reports):
+        strata = [
+            {
+                "value": {"coding": [{"system": CODE_SYSTEM, "code": code(i)}]},
+                "measureScore": {"value": rng.choice((10, 20, 250, 5000))},
+            }
+            for i in range(n_nodes)
+            if rng.random() < stratum_ratio
+        ]
+        report = {
+            "resourceType": "MeasureReport",
+            "group": [{"stratifier": [{"code": [{"coding": [{"code": "cond"}]}], "stratum": strata}]}],
+        }
+        (input_dir / f"availability_report_diz-{site}.json").write_text(json.dumps(report), encoding="utf-8")
@@ -0,0 +1,23 @@
+import stat
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
+
+from atomic_file import atomic_write, write_atomic
+
+
+def test_atomic_write_keeps_the_previous_file_and_removes_the_temp_file_on_failure(tmp_path):
+    target = tmp_path / "availability_snapshot.json.gz"
+    write_atomic(target, b"previous")
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(target) as fh:
+            fh.write(b"half")
+            raise RuntimeError("interrupted")
+
+    assert target.read_bytes() == b"previous"
+    assert [p.name for p in tmp_path.iterdir()] == [target.name]
+    assert stat.S_IMODE(target.stat().st_mode) == 0o644
@@ -1,16 +1,30 @@
 import json
 import sys
+import uuid
+import zipfile
 from pathlib import Path
 
+import pytest
+
 sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
 
-from elastic_availability_generator import ElasticAvailabilityGenerator
+from elastic_availability_generator import (
+    ElasticAvailabilityGenerator,
+    iter_ontology_nodes,
+    iter_report_strata,
+    split_ontology_file,
+)
+from json_backend import STDLIB
+from ontology_graph import OntologyGraph
 
 
 def make_generator(output_dir: Path, max_filesize_mb: float) -> ElasticAvailabilityGenerator:
     gen = object.__new__(ElasticAvailabilityGenerator)
     gen.output_dir = output_dir
     gen.MAX_FILESIZE_MB = max_filesize_mb
+    gen.json_backend = STDLIB
+    gen.skip_zero_buckets = False
+    gen._snapshot_buckets = None
     return gen
 
 
@@ -62,3 +76,410 @@ def test_write_chunked_never_splits_an_update_doc_pair_across_files(tmp_path):
         all_lines.extend(lines)
 
     assert len(all_lines) == 100
+
+
+CONTEXT = {"system": "fdpg.mii.cds", "code": "Diagnose", "version": "1.0.0"}
+
+
+def node_id(code: str) -> str:
+    """Ontology node hash of the ICD-10 code `code` in CONTEXT."""
+    raw = f"{CONTEXT['system']}{CONTEXT['code']}{CONTEXT['version']}http://fhir.de/CodeSystem/bfarm/icd-10-gm{code}"
+    return str(uuid.uuid3(ElasticAvailabilityGenerator.NAMESPACE_UUID, raw))
+
+
+def write_ontology(ontology_dir: Path, tree: dict) -> None:
+    """Writes `tree` (code -> child codes) as an ontology NDJSON export."""
+    elastic_dir = ontology_dir / "elastic"
+    elastic_dir.mkdir(parents=True, exist_ok=True)
+    lines = []
+    for code, children in tree.items():
+        lines.append(json.dumps({"index": {"_index": "ontology", "_id": node_id(code)}}))
+        lines.append(json.dumps({
+            "name": code,
+            "availability": 0,
+            "children": [{"contextualized_termcode_hash": node_id(c), "display": {"original": c}} for c in children],
+        }))
+    (elastic_dir / "onto_es__ontology_1.json").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+
+def write_report(input_dir: Path, site: str, scores: dict) -> None:
+    """Writes a MeasureReport of `site` with one stratum per code in `scores`."""
+    (input_dir / "stratum-to-context.json").write_text(json.dumps({"cond": CONTEXT}), encoding="utf-8")
+    report = {
+        "resourceType": "MeasureReport",
+        "group": [{"stratifier": [{
+            "code": [{"coding": [{"code": "cond"}]}],
+            "stratum": [
+                {
+                    "value": {"coding": [{"system": "http://fhir.de/CodeSystem/bfarm/icd-10-gm", "code": code}]},
+                    "measureScore": {"value": score},
+                }
+                for code, score in scores.items()
+            ],
+        }]}],
+    }
+    (input_dir / f"availability_report_{site}.json").write_text(json.dumps(report), encoding="utf-8")
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    input_dir, output_dir, ontology_dir = tmp_path / "input", tmp_path / "output", tmp_path / "ontology"
+    input_dir.mkdir()
+    write_ontology(ontology_dir, {"I": ["I95"], "I95": ["I95.0", "I95.1"], "I95.0": [], "I95.1": [], "J": []})
+    write_report(input_dir, "diz-1", {"I95.0": 10, "I95.1": 5})
+    return input_dir, output_dir, ontology_dir
+
+
+def written_updates(output_dir: Path) -> dict:
+    lines = []
+    for file in sorted(output_dir.glob("es_availability_update_*.json")):
+        lines.extend(read_ndjson(file))
+    return {lines[i]["update"]["_id"]: lines[i + 1]["doc"]["availability"] for i in range(0, len(lines), 2)}
+
+
+def test_generate_writes_bucket_of_every_node(dirs):
+    input_dir, output_dir, ontology_dir = dirs
+
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir).generate()
+
+    assert written_updates(output_dir) == {
+        node_id("I"): 10, node_id("I95"): 10, node_id("I95.0"): 10, node_id("I95.1"): 0, node_id("J"): 0,
+    }
+
+
+def test_generate_only_writes_nodes_whose_bucket_changed_since_last_snapshot(dirs):
+    input_dir, output_dir, ontology_dir = dirs
+    first = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1")
+    first.generate()
+    first.save_snapshot()
+
+    write_report(input_dir, "diz-2", {"I95.1": 5})
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1").generate()
+
+    assert written_updates(output_dir) == {node_id("I95.1"): 10}
+
+
+def test_generate_writes_nothing_when_no_bucket_changed(dirs):
+    input_dir, output_dir, ontology_dir = dirs
+    first = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1")
+    first.generate()
+    first.save_snapshot()
+
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1").generate()
+
+    assert list(output_dir.glob("es_availability_update_*.json")) == []
+
+
+def test_after_a_failed_upload_the_next_run_sends_every_node(dirs):
+    input_dir, output_dir, ontology_dir = dirs
+    first = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1")
+    first.generate()
+    first.save_snapshot()
+
+    write_report(input_dir, "diz-2", {"I95.1": 5})
+    second = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1")
+    second.prepare()
+    second.invalidate_snapshot()
+    # the first bulk request reached ES, then the upload failed
+    next(second.bulk_bodies())
+
+    (input_dir / "availability_report_diz-2.json").unlink()
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1").generate()
+
+    assert len(written_updates(output_dir)) == 5
+    assert written_updates(output_dir)[node_id("I95.1")] == 0
+
+
+@pytest.mark.parametrize("tag,full_refresh", [("v2", False), ("v1", True)])
+def test_generate_sends_all_nodes_for_new_ontology_tag_or_full_refresh(dirs, tag, full_refresh):
+    input_dir, output_dir, ontology_dir = dirs
+    first = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1")
+    first.generate()
+    first.save_snapshot()
+
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag=tag,
+                                 full_refresh=full_refresh).generate()
+
+    assert len(written_updates(output_dir)) == 5
+
+
+def test_generate_leaves_out_zero_buckets_only_when_sending_all_nodes(dirs):
+    input_dir, output_dir, ontology_dir = dirs
+    first = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1",
+                                         skip_zero_buckets=True)
+    first.generate()
+    first.save_snapshot()
+
+    assert first.skips_zero_buckets and first.resets_index
+    assert written_updates(output_dir) == {node_id("I"): 10, node_id("I95"): 10, node_id("I95.0"): 10}
+
+    (input_dir / "availability_report_diz-1.json").unlink()
+    write_report(input_dir, "diz-2", {"I95.1": 50})
+    second = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1",
+                                          skip_zero_buckets=True)
+    second.generate()
+
+    assert not second.skips_zero_buckets
+    assert written_updates(output_dir) == {node_id("I95.0"): 0, node_id("I95.1"): 10}
+
+    third = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1",
+                                         skip_zero_buckets=True, full_refresh=True)
+    third.generate()
+
+    assert third.skips_zero_buckets and not third.resets_index
+    assert written_updates(output_dir) == {node_id("I"): 10, node_id("I95"): 10, node_id("I95.0"): 0,
+                                           node_id("I95.1"): 10}
+
+
+def test_index_bodies_merge_the_bucket_into_every_ontology_document(dirs):
+    input_dir, output_dir, ontology_dir = dirs
+    gen = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_tag="v1")
+    gen.prepare()
+
+    lines = [json.loads(line) for body in gen.index_bodies() for line in body.splitlines()]
+
+    assert lines[0] == {"index": {"_id": node_id("I")}}
+    assert lines[1]["children"] == [{"contextualized_termcode_hash": node_id("I95"), "display": {"original": "I95"}}]
+    assert {lines[i]["index"]["_id"]: lines[i + 1]["availability"] for i in range(0, len(lines), 2)} == {
+        node_id("I"): 10, node_id("I95"): 10, node_id("I95.0"): 10, node_id("I95.1"): 0, node_id("J"): 0,
+    }
+    assert gen._current_buckets == {node_id("I"): 10, node_id("I95"): 10, node_id("I95.0"): 10}
+
+
+def test_bulk_bodies_match_the_files_written_by_generate(dirs, tmp_path):
+    input_dir, output_dir, ontology_dir = dirs
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir).generate()
+    written = [f.read_bytes() for f in sorted(output_dir.glob("es_availability_update_*.json"))]
+
+    streaming_dir = tmp_path / "streaming"
+    gen = ElasticAvailabilityGenerator(input_dir, streaming_dir, ontology_dir)
+    gen.prepare()
+
+    assert list(gen.bulk_bodies()) == written
+    assert list(streaming_dir.glob("es_availability_update_*.json")) == []
+
+
+def test_bulk_bodies_can_keep_files_for_debugging(dirs):
+    input_dir, output_dir, ontology_dir = dirs
+    gen = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir)
+    gen.prepare()
+
+    bodies = list(gen.bulk_bodies(keep_files=True))
+
+    assert [f.read_bytes() for f in sorted(output_dir.glob("es_availability_update_*.json"))] == bodies
+
+
+def test_bucketize_returns_the_largest_bucket_not_above_the_value():
+    gen = object.__new__(ElasticAvailabilityGenerator)
+
+    assert [gen._bucketize(v) for v in (0, 9, 10, 99, 100, 999_999, 1_000_000, 5_000_000)] == [
+        0, 0, 10, 10, 100, 100_000, 1_000_000, 1_000_000,
+    ]
+
+
+def test_generate_with_numpy_writes_the_same_updates(dirs, tmp_path):
+    pytest.importorskip("numpy")
+    input_dir, output_dir, ontology_dir = dirs
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir).generate()
+
+    numpy_dir = tmp_path / "numpy"
+    ElasticAvailabilityGenerator(input_dir, numpy_dir, ontology_dir, use_numpy=True).generate()
+
+    assert [f.read_bytes() for f in sorted(numpy_dir.glob("*.json"))] == [
+        f.read_bytes() for f in sorted(output_dir.glob("*.json"))
+    ]
+
+
+def test_generate_reuses_the_ontology_index_until_the_export_changes(dirs, tmp_path, monkeypatch):
+    input_dir, output_dir, ontology_dir = dirs
+    index_dir = tmp_path / "ontology_index"
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_index_dir=index_dir).generate()
+    expected = written_updates(output_dir)
+    assert (index_dir / ElasticAvailabilityGenerator.ONTOLOGY_INDEX_FILE).exists()
+
+    def parse(*_args, **_kwargs):
+        raise AssertionError("ontology export parsed despite an up-to-date index")
+
+    with monkeypatch.context() as m:
+        m.setattr(OntologyGraph, "add_node", parse)
+        ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_index_dir=index_dir).generate()
+    assert written_updates(output_dir) == expected
+
+    write_ontology(ontology_dir, {"I": ["I95"], "I95": ["I95.1"], "I95.1": [], "J": ["I95.0"], "I95.0": []})
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_index_dir=index_dir).generate()
+    assert written_updates(output_dir)[node_id("J")] == 10
+
+
+def test_iter_ontology_nodes_reads_only_the_child_hashes():
+    lines = [
+        b'{"index": {"_index": "ontology", "_id": "a"}}\n',
+        b'{"name": "A", "children" : [{"contextualized_termcode_hash": "b", "display": {"original": "]"}}], "x": 1}\n',
+        b'\n',
+        b'{"index": {"_index": "ontology", "_id": "b"}}\n',
+        b'{"name": "B", "availability": 0}\n',
+        b'{"index": {"_index": "ontology", "_id": "c"}}\n',
+        b'{"meta": {"children": 2}, "children": [{"contextualized_termcode_hash": "a"}]}',
+    ]
+
+    assert list(iter_ontology_nodes(lines)) == [("a", ["b"]), ("b", []), ("c", ["a"])]
+
+
+def test_generate_reads_the_ontology_straight_from_the_archive(dirs, tmp_path):
+    input_dir, output_dir, ontology_dir = dirs
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir).generate()
+
+    zipped_dir = tmp_path / "zipped"
+    zipped_dir.mkdir()
+    with zipfile.ZipFile(zipped_dir / ElasticAvailabilityGenerator.ONTOLOGY_ARCHIVE, "w") as zf:
+        for file in (ontology_dir / "elastic").iterdir():
+            zf.write(file, f"elastic/{file.name}")
+    zipped_output_dir = tmp_path / "zipped_output"
+    ElasticAvailabilityGenerator(input_dir, zipped_output_dir, zipped_dir).generate()
+
+    assert written_updates(zipped_output_dir) == written_updates(output_dir)
+
+
+@pytest.mark.parametrize("n_parts", [1, 2, 3, 7, 50])
+def test_split_ontology_file_ranges_start_at_index_lines_and_cover_every_node(dirs, n_parts):
+    _, _, ontology_dir = dirs
+    file = ontology_dir / "elastic" / "onto_es__ontology_1.json"
+    data = file.read_bytes()
+    expected = list(iter_ontology_nodes(data.splitlines(keepends=True)))
+
+    ranges = split_ontology_file(file, n_parts)
+
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    assert all(data[start:].startswith(b'{"index"') for start, _ in ranges)
+    nodes = []
+    for start, end in ranges:
+        nodes.extend(iter_ontology_nodes(data[start:end].splitlines(keepends=True)))
+    assert nodes == expected
+
+
+def test_generate_with_ontology_workers_writes_the_same_updates(dirs, tmp_path):
+    input_dir, output_dir, ontology_dir = dirs
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir).generate()
+
+    parallel_dir = tmp_path / "parallel"
+    gen = ElasticAvailabilityGenerator(input_dir, parallel_dir, ontology_dir, ontology_workers=3)
+    gen.MIN_ONTOLOGY_PART_BYTES = 64
+    gen.generate()
+
+    assert [f.read_bytes() for f in sorted(parallel_dir.glob("*.json"))] == [
+        f.read_bytes() for f in sorted(output_dir.glob("*.json"))
+    ]
+
+
+@pytest.mark.parametrize("name", ["orjson", "simdjson"])
+def test_generate_writes_the_same_updates_with_every_json_backend(dirs, tmp_path, name):
+    input_dir, output_dir, ontology_dir = dirs
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, json_backend="stdlib").generate()
+
+    backend_dir = tmp_path / name
+    ElasticAvailabilityGenerator(input_dir, backend_dir, ontology_dir, json_backend=name).generate()
+
+    assert written_updates(backend_dir) == written_updates(output_dir)
+
+
+def test_build_updates_encodes_the_same_bytes_as_json_dumps(tmp_path):
+    gen = make_generator(tmp_path, max_filesize_mb=10)
+    gen.use_numpy = False
+    gen._previous_buckets = None
+    gen._current_buckets = {}
+    ids = [node_id("I95"), 'quote"d', "back\\slash", "tab\tnewline\n", "Hypotonie ä ☃"]
+    gen.graph = OntologyGraph()
+    for i in ids:
+        gen.graph.add_node(i, [])
+    gen.graph.finalize()
+    totals = [0, 10, 250, 1_000_000, 5]
+
+    expected = [
+        "".join(json.dumps(doc, ensure_ascii=False) + "\n" for doc in (
+            {"update": {"_id": i}}, {"doc": {"availability": gen._bucketize(total)}},
+        )).encode("utf-8")
+        for i, total in zip(ids, totals)
+    ]
+    assert list(gen._build_updates(totals)) == expected
+
+
+def test_reports_hash_every_termcode_once_and_reuse_the_stored_nodes(dirs, tmp_path, monkeypatch):
+    input_dir, output_dir, ontology_dir = dirs
+    write_report(input_dir, "diz-2", {"I95.0": 10, "I95.1": 5, "X00": 1})
+    index_dir = tmp_path / "ontology_index"
+
+    hashed = []
+    uuid3 = uuid.uuid3
+    monkeypatch.setattr(uuid, "uuid3", lambda namespace, name: hashed.append(name) or uuid3(namespace, name))
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_index_dir=index_dir).generate()
+    expected = written_updates(output_dir)
+
+    assert len(hashed) == len(set(hashed)) == 3
+    assert expected[node_id("I95.1")] == 10
+
+    hashed.clear()
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, ontology_index_dir=index_dir).generate()
+
+    assert hashed == []
+    assert written_updates(output_dir) == expected
+
+
+def test_iter_report_strata_pairs_every_stratum_with_its_stratifier_code(tmp_path):
+    pytest.importorskip("ijson")
+    stratum = {"value": {"coding": [{"system": "s", "code": "c"}]}, "measureScore": {"value": 10}}
+    report = {"group": [
+        {"stratifier": [
+            {"code": [{"coding": [{"code": "first"}]}], "stratum": [stratum, stratum]},
+            {"stratum": [stratum], "code": [{"coding": [{"code": "code-last"}, {"code": "ignored"}]}]},
+        ]},
+        {"stratifier": [{"code": [{"coding": [{"code": "no-strata"}]}]}]},
+    ]}
+    (tmp_path / "report.json").write_text(json.dumps(report), encoding="utf-8")
+
+    with (tmp_path / "report.json").open("rb") as fh:
+        strata = list(iter_report_strata(fh))
+
+    assert strata == [("first", stratum), ("first", stratum), ("code-last", stratum)]
+
+
+def test_generate_with_streamed_reports_writes_the_same_updates(dirs, tmp_path):
+    pytest.importorskip("ijson")
+    input_dir, output_dir, ontology_dir = dirs
+    write_report(input_dir, "diz-2", {"I95.1": 5.0, "I95": 3})
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir).generate()
+
+    streaming_dir = tmp_path / "streaming"
+    ElasticAvailabilityGenerator(input_dir, streaming_dir, ontology_dir, stream_reports=True).generate()
+
+    assert written_updates(streaming_dir) == written_updates(output_dir)
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_update_from_reports_with_workers_matches_the_sequential_totals(dirs, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    input_dir, output_dir, ontology_dir = dirs
+    write_report(input_dir, "diz-2", {"I95.1": 5.7, "I95": 3, "X00": 1})
+    write_report(input_dir, "diz-3", {"I95.0": 2.5, "J": 1_000_000})
+
+    sequential = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir)
+    sequential.prepare()
+    parallel = ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir, report_workers=3,
+                                            use_numpy=use_numpy)
+    parallel.prepare()
+
+    assert list(parallel.graph.availability) == list(sequential.graph.availability)
+    assert parallel.graph.availability[parallel.graph.find(node_id("I95.1"))] == 10
+
+
+def test_generate_with_reports_received_in_memory_writes_the_same_updates(dirs, tmp_path):
+    input_dir, output_dir, ontology_dir = dirs
+    write_report(input_dir, "diz-2", {"I95.1": 5})
+    ElasticAvailabilityGenerator(input_dir, output_dir, ontology_dir).generate()
+
+    memory_dir = tmp_path / "memory"
+    gen = ElasticAvailabilityGenerator(input_dir, memory_dir, ontology_dir, in_memory_reports=True)
+    gen.add_report_scores(gen.parse_report((input_dir / "availability_report_diz-1.json").read_bytes()))
+    gen.add_report_scores(gen.parse_report((input_dir / "availability_report_diz-2.json").read_bytes()))
+    gen.generate()
+
+    assert written_updates(memory_dir) == written_updates(output_dir)
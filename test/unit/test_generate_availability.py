@@ -1,17 +1,35 @@
 import base64
+import errno
+import gzip
+import hashlib
+import json
 import io
 import sys
 import threading
 import zipfile
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
+from typing import Optional
 
 import pytest
 import requests
 
 sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
 
-from generate_availability import build_onto_repo_auth, download_and_unzip
+import generate_availability
+from generate_availability import (
+    ReleaseManifest,
+    ReportCache,
+    build_onto_repo_auth,
+    download_and_unzip,
+    download_availability_reports,
+    read_checksums,
+    rebuild_index_blue_green,
+    reset_availability_in_es,
+    update_availability_in_es,
+    update_release_archive,
+    upload_bulk_bodies,
+)
 
 
 def test_build_onto_repo_auth_returns_none_when_both_unset():
@@ -32,22 +50,33 @@ def test_build_onto_repo_auth_raises_when_only_one_is_set(username, password):
 
 
 class FakeResponse:
-    def __init__(self, content: bytes):
+    def __init__(self, content: bytes, status_code: int = 200, headers: Optional[dict] = None, fail_after: Optional[int] = None):
         self.content = content
-        self.headers = {"Content-Type": "application/zip"}
+        self.status_code = status_code
+        self.headers = {"Content-Type": "application/zip", **(headers or {})}
         self.text = ""
+        self._fail_after = fail_after
 
     def raise_for_status(self):
         pass
 
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            if self._fail_after is not None and start >= self._fail_after:
+                raise requests.exceptions.ChunkedEncodingError("connection broken")
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
 
 class FakeSession:
     def __init__(self, content: bytes):
         self._content = content
         self.calls = []
 
-    def get(self, url, timeout=None, auth=None):
-        self.calls.append({"url": url, "auth": auth})
+    def get(self, url, timeout=None, auth=None, stream=False, headers=None):
+        self.calls.append({"url": url, "auth": auth, "headers": headers})
         return FakeResponse(self._content)
 
 
@@ -88,6 +117,150 @@ def test_download_and_unzip_clears_stale_files_from_a_previous_run(tmp_path):
     assert (tmp_path / "elastic" / "onto_es__ontology_1.json").exists()
 
 
+class FlakySession(FakeSession):
+    """
+    Drops the connection once after `fail_after` bytes, then refuses `refused`
+    connects, and answers range requests with 206.
+    """
+
+    def __init__(self, content: bytes, fail_after: int, supports_ranges: bool = True, etag: Optional[str] = None,
+                 refused: int = 0):
+        super().__init__(content)
+        self._fail_after = fail_after
+        self._supports_ranges = supports_ranges
+        self._etag = etag
+        self._refused = refused
+
+    def get(self, url, timeout=None, auth=None, stream=False, headers=None):
+        self.calls.append({"url": url, "auth": auth, "headers": headers})
+        if len(self.calls) == 1:
+            return FakeResponse(self._content, fail_after=self._fail_after,
+                                headers={"ETag": self._etag} if self._etag else None)
+        if len(self.calls) <= 1 + self._refused:
+            raise requests.ConnectionError("connection refused")
+        if headers and self._supports_ranges:
+            offset = int(headers["Range"][len("bytes="):-1])
+            return FakeResponse(self._content[offset:], status_code=206)
+        return FakeResponse(self._content)
+
+
+@pytest.mark.parametrize("supports_ranges", [True, False])
+def test_download_and_unzip_resumes_an_interrupted_download(tmp_path, monkeypatch, supports_ranges):
+    monkeypatch.setattr(generate_availability, "ZIP_DOWNLOAD_CHUNK_SIZE", 16)
+    monkeypatch.setattr(generate_availability.time, "sleep", lambda s: None)
+    zip_bytes = make_zip_bytes()
+    session = FlakySession(zip_bytes, fail_after=32, supports_ranges=supports_ranges)
+
+    archive = download_and_unzip(session, "https://example/elastic.zip", tmp_path / "ontology")
+
+    assert [call["headers"] for call in session.calls] == [None, {"Range": "bytes=32-"}]
+    assert archive.sha256 == hashlib.sha256(zip_bytes).hexdigest()
+    assert (tmp_path / "ontology" / "elastic" / "onto_es__ontology_1.json").exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["ontology"]
+
+
+def test_download_and_unzip_retries_a_failed_resume_conditional_on_the_etag(tmp_path, monkeypatch):
+    monkeypatch.setattr(generate_availability, "ZIP_DOWNLOAD_CHUNK_SIZE", 16)
+    monkeypatch.setattr(generate_availability.time, "sleep", lambda s: None)
+    zip_bytes = make_zip_bytes()
+    session = FlakySession(zip_bytes, fail_after=32, etag='"v1"', refused=2)
+
+    archive = download_and_unzip(session, "https://example/elastic.zip", tmp_path / "ontology")
+
+    resume = {"Range": "bytes=32-", "If-Range": '"v1"'}
+    assert [call["headers"] for call in session.calls] == [None, resume, resume, resume]
+    assert archive == (hashlib.sha256(zip_bytes).hexdigest(), '"v1"', ("elastic/onto_es__ontology_1.json",))
+
+
+def test_download_and_unzip_replaces_the_content_of_a_mount_point(tmp_path, monkeypatch):
+    target = tmp_path / "ontology"
+    stale_file = target / "elastic" / "onto_es__ontology_old.json"
+    stale_file.parent.mkdir(parents=True)
+    stale_file.write_text("stale from a previous release")
+    rename = Path.rename
+
+    def rename_unless_mount_point(self, new):
+        if self == target:
+            raise OSError(errno.EBUSY, "Device or resource busy")
+        return rename(self, new)
+
+    monkeypatch.setattr(Path, "rename", rename_unless_mount_point)
+
+    download_and_unzip(FakeSession(make_zip_bytes()), "https://example/elastic.zip", target)
+
+    assert not stale_file.exists()
+    assert (target / "elastic" / "onto_es__ontology_1.json").exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["ontology"]
+
+
+def test_download_and_unzip_keeps_the_previous_release_on_checksum_mismatch(tmp_path):
+    previous = tmp_path / "ontology" / "elastic" / "onto_es__ontology_1.json"
+    previous.parent.mkdir(parents=True)
+    previous.write_text("previous release")
+    session = FakeSession(make_zip_bytes())
+
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        download_and_unzip(session, "https://example/elastic.zip", tmp_path / "ontology", sha256="0" * 64)
+
+    assert previous.read_text() == "previous release"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["ontology"]
+
+
+class ReleaseServer(FakeSession):
+    """Serves the archive with `etag` (if any) and answers a matching If-None-Match with 304."""
+
+    def __init__(self, content: bytes, etag: Optional[str] = None):
+        super().__init__(content)
+        self.etag = etag
+
+    def get(self, url, timeout=None, auth=None, stream=False, headers=None):
+        self.calls.append({"url": url, "auth": auth, "headers": headers})
+        if self.etag and (headers or {}).get("If-None-Match") == self.etag:
+            return FakeResponse(b"", status_code=304)
+        return FakeResponse(self._content, headers={"ETag": self.etag} if self.etag else None)
+
+
+@pytest.mark.parametrize("etag", ['"v8.3.1-1"', None])
+def test_update_release_archive_reuses_an_unchanged_release(tmp_path, etag):
+    url = "https://example/v8.3.1/elastic.zip"
+    ontology_dir = tmp_path / "ontology"
+    server = ReleaseServer(make_zip_bytes(), etag=etag)
+
+    assert update_release_archive(server, ReleaseManifest(ontology_dir / ReleaseManifest.FILE), "v8.3.1", url,
+                                  ontology_dir)
+    downloaded = [update_release_archive(server, ReleaseManifest(ontology_dir / ReleaseManifest.FILE), "v8.3.1",
+                                         url, ontology_dir)]
+
+    (ontology_dir / "elastic" / "onto_es__ontology_1.json").unlink()
+    downloaded.append(update_release_archive(server, ReleaseManifest(ontology_dir / ReleaseManifest.FILE),
+                                             "v8.3.1", url, ontology_dir))
+
+    assert downloaded == [False, True]
+    expected_headers = [None, {"If-None-Match": etag}, None] if etag else [None, None]
+    assert [call["headers"] for call in server.calls] == expected_headers
+    assert (ontology_dir / "elastic" / "onto_es__ontology_1.json").exists()
+
+
+def test_update_release_archive_verifies_against_the_checksums_file(tmp_path):
+    url = "https://example/v8.3.1/elastic.zip"
+    ontology_dir = tmp_path / "ontology"
+    zip_bytes = make_zip_bytes()
+    checksums_file = tmp_path / "SHA256SUMS"
+    checksums_file.write_text(f"{hashlib.sha256(zip_bytes).hexdigest()}  elastic.zip\n{'0' * 64} *availability.zip\n")
+    checksums = read_checksums(checksums_file)
+    server = ReleaseServer(zip_bytes)
+
+    assert update_release_archive(server, ReleaseManifest(ontology_dir / ReleaseManifest.FILE), "v8.3.1", url,
+                                  ontology_dir, sha256=checksums["elastic.zip"])
+    # a re-published release with another checksum is downloaded again, and rejected
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        update_release_archive(server, ReleaseManifest(ontology_dir / ReleaseManifest.FILE), "v8.3.1", url,
+                               ontology_dir, sha256=checksums["availability.zip"])
+
+    assert len(server.calls) == 2
+    assert (ontology_dir / "elastic" / "onto_es__ontology_1.json").exists()
+
+
 def _make_basic_auth_server(expected_username: str, expected_password: str, zip_bytes: bytes) -> HTTPServer:
     """A real loopback HTTP server that challenges Basic Auth the way an
     artifactory proxy would, so tests exercise an actual request/response
@@ -296,3 +469,394 @@ def test_download_and_unzip_survives_redirect_to_presigned_storage(tmp_path):
     finally:
         proxy.shutdown()
         storage.shutdown()
+
+
+MASTER_IDENT = "fdpg-data-availability-report-obfuscated"
+
+
+def make_docref(author: str, report_id: str, date: str = "2024-10-29T09:39:54.839Z") -> dict:
+    return {
+        "resourceType": "DocumentReference",
+        "date": date,
+        "masterIdentifier": {
+            "system": "http://medizininformatik-initiative.de/sid/project-identifier",
+            "value": MASTER_IDENT,
+        },
+        "author": [{"identifier": {"value": author}}],
+        "content": [{"attachment": {"url": f"MeasureReport/{report_id}"}}],
+    }
+
+
+class FakeJsonResponse:
+    def __init__(self, payload, status_code: int = 200, headers=None):
+        self._payload = payload
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return self._payload
+
+    @property
+    def content(self) -> bytes:
+        return json.dumps(self._payload).encode("utf-8")
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+
+class FakeReportServer:
+    """Answers the docref search page by page and serves each site's
+    MeasureReport, optionally failing some of them."""
+
+    def __init__(self, docrefs, failing_reports=(), page_size=100):
+        self.docrefs = docrefs
+        self.failing_reports = set(failing_reports)
+        self.page_size = page_size
+        self.search_params = []
+        self.report_requests = []
+
+    def get(self, url, timeout=None, params=None, headers=None, **kwargs):
+        if "/DocumentReference" in url:
+            self.search_params.append(params)
+            offset = int(url.split("__offset=")[1]) if "__offset=" in url else 0
+            page = self.docrefs[offset:offset + self.page_size]
+            bundle = {"entry": [{"resource": d} for d in page]}
+            if offset + self.page_size < len(self.docrefs):
+                bundle["link"] = [{"relation": "next", "url": f"http://fhir/DocumentReference?__offset={offset + self.page_size}"}]
+            return FakeJsonResponse(bundle)
+
+        report_id = url.rsplit("/", 1)[-1]
+        self.report_requests.append((report_id, headers or {}))
+        if report_id in self.failing_reports:
+            return FakeJsonResponse({}, status_code=503)
+        etag = f'W/"{report_id}-1"'
+        if (headers or {}).get("If-None-Match") == etag:
+            return FakeJsonResponse(None, status_code=304)
+        return FakeJsonResponse({"resourceType": "MeasureReport", "id": report_id}, headers={"ETag": etag})
+
+
+def test_download_availability_reports_fetches_all_reports_concurrently(tmp_path):
+    server = FakeReportServer([make_docref(f"diz-{i}", f"r{i}") for i in range(8)])
+
+    n = download_availability_reports(server, tmp_path, "http://fhir", MASTER_IDENT, concurrency=4)
+
+    assert n == 8
+    assert sorted(f.name for f in tmp_path.glob("availability_report_*.json")) == sorted(
+        f"availability_report_diz-{i}.json" for i in range(8)
+    )
+    assert not list(tmp_path.glob(".tmp-*"))
+
+
+def test_download_availability_reports_removes_reports_of_a_previous_run(tmp_path):
+    (tmp_path / "availability_report_diz-gone.json").write_text("{}")
+    (tmp_path / "stratum-to-context.json").write_text("{}")
+    server = FakeReportServer([make_docref("diz-0", "r0")])
+
+    download_availability_reports(server, tmp_path, "http://fhir", MASTER_IDENT)
+
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["availability_report_diz-0.json", "stratum-to-context.json"]
+
+
+def test_download_availability_reports_skips_failing_site_without_aborting(tmp_path):
+    server = FakeReportServer(
+        [make_docref("diz-ok", "r-ok"), make_docref("diz-down", "r-down")],
+        failing_reports={"r-down"},
+    )
+
+    n = download_availability_reports(server, tmp_path, "http://fhir", MASTER_IDENT, concurrency=2)
+
+    assert n == 1
+    assert (tmp_path / "availability_report_diz-ok.json").exists()
+    assert not (tmp_path / "availability_report_diz-down.json").exists()
+
+
+def test_download_availability_reports_falls_back_to_the_cached_report_of_a_failing_site(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    docrefs = [make_docref("diz-ok", "r-ok"), make_docref("diz-down", "r-down", date="2024-01-01T00:00:00Z")]
+    download_availability_reports(FakeReportServer(docrefs), input_dir, "http://fhir", MASTER_IDENT,
+                                  cache=ReportCache(tmp_path / "cache"))
+
+    docrefs[1] = make_docref("diz-down", "r-down", date="2024-02-01T00:00:00Z")
+    docrefs.append(make_docref("diz-new", "r-new"))
+    server = FakeReportServer(docrefs, failing_reports={"r-down", "r-new"})
+    received = []
+    n = download_availability_reports(server, input_dir, "http://fhir", MASTER_IDENT,
+                                      cache=ReportCache(tmp_path / "cache"),
+                                      parse_report=lambda body: json.loads(body)["id"], on_report=received.append)
+
+    assert n == 2
+    assert sorted(received) == ["r-down", "r-ok"]
+    assert json.loads((input_dir / "availability_report_diz-down.json").read_text())["id"] == "r-down"
+    assert not (input_dir / "availability_report_diz-new.json").exists()
+
+
+def test_download_availability_reports_follows_next_links_past_the_first_page(tmp_path):
+    server = FakeReportServer([make_docref(f"diz-{i}", f"r{i}") for i in range(25)], page_size=10)
+
+    n = download_availability_reports(server, tmp_path, "http://fhir", MASTER_IDENT)
+
+    assert n == 25
+    assert len(server.search_params) == 3
+    assert server.search_params[0]["identifier"] == (
+        f"http://medizininformatik-initiative.de/sid/project-identifier|{MASTER_IDENT}"
+    )
+    # follow-up pages are requested via the next link alone
+    assert server.search_params[1:] == [None, None]
+
+
+def test_download_availability_reports_uses_only_the_newest_docref_per_author(tmp_path):
+    server = FakeReportServer([
+        make_docref("diz-1", "old", date="2024-01-01T00:00:00Z"),
+        make_docref("diz-1", "new", date="2024-06-01T00:00:00+02:00"),
+        make_docref("diz-1", "older", date="2023-01-01T00:00:00Z"),
+    ])
+
+    n = download_availability_reports(server, tmp_path, "http://fhir", MASTER_IDENT)
+
+    assert n == 1
+    report = json.loads((tmp_path / "availability_report_diz-1.json").read_text())
+    assert report["id"] == "new"
+
+
+def test_download_availability_reports_reuses_cached_report_when_docref_is_unchanged(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    cache = ReportCache(tmp_path / "cache")
+    server = FakeReportServer([make_docref("diz-1", "r1")])
+
+    download_availability_reports(server, input_dir, "http://fhir", MASTER_IDENT, cache=cache)
+    (input_dir / "availability_report_diz-1.json").unlink()
+    server.report_requests.clear()
+    parsed = []
+
+    n = download_availability_reports(server, input_dir, "http://fhir", MASTER_IDENT,
+                                      cache=ReportCache(tmp_path / "cache"), parse_report=parsed.append)
+
+    assert n == 1
+    assert server.report_requests == []
+    assert parsed == []
+    assert json.loads((input_dir / "availability_report_diz-1.json").read_text())["id"] == "r1"
+
+
+def test_download_availability_reports_sends_conditional_request_when_docref_changed(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    server = FakeReportServer([make_docref("diz-1", "r1", date="2024-01-01T00:00:00Z")])
+    download_availability_reports(server, input_dir, "http://fhir", MASTER_IDENT, cache=ReportCache(tmp_path / "cache"))
+
+    server.docrefs = [make_docref("diz-1", "r1", date="2024-02-01T00:00:00Z")]
+    server.report_requests.clear()
+    n = download_availability_reports(server, input_dir, "http://fhir", MASTER_IDENT, cache=ReportCache(tmp_path / "cache"))
+
+    assert n == 1
+    assert server.report_requests == [("r1", {"If-None-Match": 'W/"r1-1"'})]
+    assert json.loads((input_dir / "availability_report_diz-1.json").read_text())["id"] == "r1"
+
+
+@pytest.mark.parametrize("keep_files", [False, True])
+def test_download_availability_reports_hands_parsed_reports_to_the_caller(tmp_path, keep_files):
+    server = FakeReportServer([make_docref(f"diz-{i}", f"r{i}") for i in range(3)], failing_reports={"r2"})
+    received = []
+
+    n = download_availability_reports(server, tmp_path, "http://fhir", MASTER_IDENT, concurrency=2,
+                                      parse_report=lambda body: json.loads(body)["id"],
+                                      on_report=received.append, keep_files=keep_files)
+
+    assert n == 2
+    assert sorted(received) == ["r0", "r1"]
+    written = sorted(f.name for f in tmp_path.glob("availability_report_*.json"))
+    if keep_files:
+        assert written == ["availability_report_diz-0.json", "availability_report_diz-1.json"]
+        assert (tmp_path / "availability_report_diz-0.json").read_bytes() == server.get("http://fhir/r0").content
+    else:
+        assert written == []
+
+
+def bulk_body(*ids) -> bytes:
+    return b"".join(
+        f'{{"update": {{"_id": "{i}"}}}}\n{{"doc": {{"availability": 10}}}}\n'.encode() for i in ids
+    )
+
+
+def bulk_result(statuses: dict) -> dict:
+    return {
+        "errors": any(status >= 300 for status in statuses.values()),
+        "items": [
+            {"update": {"_id": i, "status": status, **({"error": {"type": "x"}} if status >= 300 else {})}}
+            for i, status in statuses.items()
+        ],
+    }
+
+
+class FakeElastic:
+    """Replays the given bulk responses and records the ids of every request."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.encodings = []
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        self.encodings.append((headers or {}).get("Content-Encoding"))
+        if (headers or {}).get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        ids = [json.loads(line)["update"]["_id"] for line in data.splitlines()[::2]]
+        self.requests.append(ids)
+        status, payload = self.responses.pop(0)
+        return FakeJsonResponse(payload, status_code=status)
+
+
+def test_update_availability_in_es_resubmits_only_the_throttled_items(tmp_path):
+    (tmp_path / "es_availability_update_1.json").write_bytes(bulk_body("a", "b", "c"))
+    es = FakeElastic([
+        (429, {}),
+        (200, bulk_result({"a": 200, "b": 429, "c": 200})),
+        (200, bulk_result({"b": 200})),
+    ])
+
+    stats = update_availability_in_es(es, "http://es", "ontology", tmp_path, backoff=0)
+
+    assert es.requests == [["a", "b", "c"], ["a", "b", "c"], ["b"]]
+    assert (stats.docs, stats.rejected, stats.retried) == (3, 0, 1)
+
+
+def test_update_availability_in_es_fails_when_documents_are_rejected(tmp_path):
+    (tmp_path / "es_availability_update_1.json").write_bytes(bulk_body("a", "missing"))
+    (tmp_path / "es_availability_update_2.json").write_bytes(bulk_body("b"))
+    es = FakeElastic([
+        (200, bulk_result({"a": 200, "missing": 404})),
+        (200, bulk_result({"b": 200})),
+    ])
+
+    with pytest.raises(RuntimeError, match="1 rejected"):
+        update_availability_in_es(es, "http://es", "ontology", tmp_path, backoff=0)
+
+    assert len(es.requests) == 2
+
+
+def test_update_availability_in_es_fails_on_unacknowledged_items_and_unexpected_errors(tmp_path):
+    (tmp_path / "es_availability_update_1.json").write_bytes(bulk_body("a"))
+    (tmp_path / "es_availability_update_2.json").write_bytes(bulk_body("b"))
+    es = FakeElastic([
+        (200, {"errors": True, "items": [{}]}),
+        (200, ["not", "a", "bulk", "result"]),
+    ])
+
+    with pytest.raises(RuntimeError, match="1 failed requests, 1 rejected"):
+        update_availability_in_es(es, "http://es", "ontology", tmp_path, backoff=0)
+
+
+def test_upload_bulk_bodies_sends_bodies_while_they_are_produced(tmp_path):
+    es = FakeElastic([(200, bulk_result({str(i): 200})) for i in range(6)])
+    produced = []
+
+    def bodies():
+        for i in range(6):
+            produced.append(i)
+            yield bulk_body(str(i))
+
+    stats = upload_bulk_bodies(es, "http://es", "ontology", bodies(), concurrency=2)
+
+    assert produced == list(range(6))
+    assert sorted(ids[0] for ids in es.requests) == [str(i) for i in range(6)]
+    assert stats.docs == 6
+
+
+def test_update_availability_in_es_can_gzip_bulk_bodies_including_retries(tmp_path):
+    (tmp_path / "es_availability_update_1.json").write_bytes(bulk_body("a", "b"))
+    es = FakeElastic([
+        (200, bulk_result({"a": 200, "b": 429})),
+        (200, bulk_result({"b": 200})),
+    ])
+
+    stats = update_availability_in_es(es, "http://es", "ontology", tmp_path, backoff=0, compress=True)
+
+    assert es.requests == [["a", "b"], ["b"]]
+    assert es.encodings == ["gzip", "gzip"]
+    assert stats.docs == 2
+
+
+def test_reset_availability_in_es_sets_non_zero_nodes_to_zero():
+    requests_made = []
+
+    class FakeSession:
+        def post(self, url, params=None, json=None, timeout=None):
+            requests_made.append((url, json))
+            return FakeJsonResponse({"updated": 3, "failures": []})
+
+    assert reset_availability_in_es(FakeSession(), "http://es", "ontology") == 3
+
+    url, body = requests_made[0]
+    assert url == "http://es/ontology/_update_by_query"
+    assert body["query"] == {"bool": {"must_not": {"term": {"availability": 0}}}}
+
+
+class FakeCluster:
+    """Records the requests of an index rebuild against `indices` (index name -> aliases)."""
+
+    def __init__(self, indices, bulk_status: int = 200):
+        self.indices = indices
+        self.bulk_status = bulk_status
+        self.requests = []
+
+    def get(self, url, timeout=None):
+        self.requests.append(("GET", url, None))
+        return FakeJsonResponse({
+            name: {
+                "aliases": {alias: {} for alias in aliases},
+                "mappings": {"properties": {"availability": {"type": "integer"}}},
+                "settings": {"index": {"number_of_shards": "1", "number_of_replicas": "1", "uuid": "x",
+                                       "creation_date": "1", "provided_name": name}},
+            }
+            for name, aliases in self.indices.items()
+        })
+
+    def put(self, url, json=None, timeout=None):
+        self.requests.append(("PUT", url, json))
+        return FakeJsonResponse({})
+
+    def post(self, url, headers=None, data=None, json=None, timeout=None):
+        self.requests.append(("POST", url, json))
+        if url.endswith("/_bulk"):
+            return FakeJsonResponse({"errors": False, "items": [{}]}, status_code=self.bulk_status)
+        return FakeJsonResponse({})
+
+    def delete(self, url, timeout=None):
+        self.requests.append(("DELETE", url, None))
+        return FakeJsonResponse({})
+
+
+@pytest.mark.parametrize("indices,expected_actions,deleted", [
+    ({"ontology": []}, [{"remove_index": {"index": "ontology"}}], []),
+    ({"ontology-1": ["ontology", "search"]},
+     [{"remove": {"index": "ontology-1", "alias": "ontology"}}], ["http://es/ontology-1"]),
+])
+def test_rebuild_index_blue_green_loads_a_new_index_and_swaps_the_alias(indices, expected_actions, deleted):
+    es = FakeCluster(indices)
+
+    new_index = rebuild_index_blue_green(es, "http://es", "ontology", [b'{"index": {"_id": "a"}}\n{}\n'])
+
+    method, url, body = es.requests[1]
+    assert (method, url) == ("PUT", f"http://es/{new_index}")
+    assert body["settings"]["index"] == {"number_of_shards": "1", "number_of_replicas": 0, "refresh_interval": "-1"}
+    assert ("POST", f"http://es/{new_index}/_bulk", None) in es.requests
+    assert ("PUT", f"http://es/{new_index}/_settings",
+            {"index": {"number_of_replicas": "1", "refresh_interval": None}}) in es.requests
+
+    actions = next(body for method, url, body in es.requests if url == "http://es/_aliases")["actions"]
+    extra_aliases = [{"add": {"index": new_index, "alias": "search"}}] if "ontology-1" in indices else []
+    assert actions == extra_aliases + [{"add": {"index": new_index, "alias": "ontology"}}] + expected_actions
+    assert [url for method, url, body in es.requests if method == "DELETE"] == deleted
+
+
+def test_rebuild_index_blue_green_deletes_the_new_index_when_loading_fails():
+    es = FakeCluster({"ontology": []}, bulk_status=400)
+
+    with pytest.raises(RuntimeError):
+        rebuild_index_blue_green(es, "http://es", "ontology", [b'{"index": {"_id": "a"}}\n{}\n'])
+
+    new_index = es.requests[1][1]
+    assert es.requests[-1] == ("DELETE", new_index, None)
+    assert not any(url == "http://es/_aliases" for method, url, body in es.requests)
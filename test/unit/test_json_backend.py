@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
+
+import json_backend
+from json_backend import STDLIB, get_backend
+
+
+@pytest.mark.parametrize("name", ["stdlib", "orjson", "simdjson"])
+def test_backends_round_trip_non_ascii_without_escaping(name):
+    backend = get_backend(name)
+
+    data = backend.dumps({"display": "Hypotonie ä", "n": [1, 2]})
+
+    assert "ä".encode("utf-8") in data
+    assert backend.loads(data) == {"display": "Hypotonie ä", "n": [1, 2]}
+
+
+def test_auto_uses_orjson_or_stdlib_but_never_simdjson(monkeypatch):
+    monkeypatch.setattr(json_backend, "orjson", None)
+    monkeypatch.setattr(json_backend, "simdjson", pytest.importorskip("simdjson"))
+
+    assert get_backend("auto") is STDLIB
+    assert get_backend("simdjson").name == "simdjson"
+
+
+def test_get_backend_falls_back_to_stdlib_when_not_installed(monkeypatch):
+    monkeypatch.setattr(json_backend, "orjson", None)
+    monkeypatch.setattr(json_backend, "simdjson", None)
+
+    assert get_backend("orjson") is STDLIB
+    assert get_backend("auto") is STDLIB
+    with pytest.raises(ValueError):
+        get_backend("ujson")
@@ -0,0 +1,166 @@
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
+
+import ontology_graph
+from ontology_graph import OntologyGraph, node_key
+
+
+def make_graph(availability: dict, children: dict) -> OntologyGraph:
+    graph = OntologyGraph()
+    for node_id in availability:
+        graph.add_node(node_id, children[node_id] or ())
+    graph.finalize()
+    for node_id, value in availability.items():
+        graph.availability[graph.find(node_id)] = value
+    return graph
+
+
+def recursive_rollup(availability: dict, children: dict) -> dict:
+    """The recursive roll-up the generator used before the iterative engine."""
+    cache = {}
+
+    def accumulate(node_id, in_progress):
+        if node_id in cache:
+            return cache[node_id]
+        total = availability[node_id]
+        in_progress.add(node_id)
+        for child_id in children[node_id] or ():
+            if child_id not in availability or child_id in in_progress:
+                continue
+            total += accumulate(child_id, in_progress)
+        in_progress.discard(node_id)
+        cache[node_id] = total
+        return total
+
+    return {node_id: accumulate(node_id, set()) for node_id in availability}
+
+
+def test_finalize_numbers_nodes_in_definition_order_and_keeps_child_order():
+    graph = OntologyGraph()
+    graph.add_node("root", ["b", "a", "missing"])
+    graph.add_node("a", [])
+    graph.add_node("b", ["a"])
+    graph.finalize()
+
+    assert list(graph.iter_ids()) == ["root", "a", "b"]
+    assert [graph.find(h) for h in ("root", "a", "b", "missing")] == [0, 1, 2, None]
+    assert list(graph.children(0)) == [2, 1]
+    assert list(graph.children(1)) == []
+    assert list(graph.children(2)) == [1]
+    assert list(graph.availability) == [0, 0, 0]
+
+
+@pytest.mark.parametrize("with_numpy", [True, False])
+def test_finalize_keeps_children_of_the_last_definition_of_a_node(monkeypatch, with_numpy):
+    if with_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(ontology_graph, "np", None)
+    graph = OntologyGraph()
+    graph.add_node("a", ["b"])
+    graph.add_node("b", [])
+    graph.add_node("c", [])
+    graph.add_node("a", ["d"])
+    graph.add_node("d", [])
+    graph.add_node("a", ["c"])
+    graph.finalize()
+
+    assert list(graph.iter_ids()) == ["a", "b", "c", "d"]
+    assert [graph.find(h) for h in ("a", "b", "c", "d")] == [0, 1, 2, 3]
+    assert list(graph.children(0)) == [2]
+
+
+def test_merge_appends_the_nodes_of_another_graph_as_if_added_in_order():
+    first, second, expected = OntologyGraph(), OntologyGraph(), OntologyGraph()
+    for graph, nodes in ((first, [("a", ["c"]), ("b", [])]), (second, [("c", ["b"]), ("a", ["b", "c"])])):
+        for node_hash, children in nodes:
+            graph.add_node(node_hash, children)
+            expected.add_node(node_hash, children)
+
+    first.merge(second)
+    first.finalize()
+    expected.finalize()
+
+    assert list(first.iter_ids()) == list(expected.iter_ids()) == ["a", "b", "c"]
+    assert [list(first.children(i)) for i in range(3)] == [[1, 2], [], [1]]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_rollup_matches_recursive_rollup_on_graphs_with_shared_children_and_cycles(seed):
+    rng = random.Random(seed)
+    nodes = [f"n{i}" for i in range(60)]
+    availability = {n: rng.choice([0, 0, 1, 7, 30]) for n in nodes}
+    children = {
+        n: [rng.choice(nodes + ["missing"]) for _ in range(rng.randint(0, 4))] or None
+        for n in nodes
+    }
+
+    graph = make_graph(availability, children)
+
+    assert dict(zip(graph.iter_ids(), graph.rollup())) == recursive_rollup(availability, children)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_rollup_numpy_matches_rollup_on_graphs_with_shared_children_and_cycles(seed):
+    pytest.importorskip("numpy")
+    rng = random.Random(seed)
+    nodes = [f"n{i}" for i in range(200)]
+    availability = {n: rng.choice([0, 0, 1, 7, 30]) for n in nodes}
+    # mostly children further down the list, with the occasional back reference
+    children = {
+        n: [nodes[min(i + rng.randint(1, 20), 199)] if rng.random() > 0.02 else rng.choice(nodes)
+            for _ in range(rng.randint(0, 3))] or None
+        for i, n in enumerate(nodes)
+    }
+
+    graph = make_graph(availability, children)
+
+    assert graph.rollup_numpy() == graph.rollup()
+
+
+def test_rollup_handles_hierarchies_deeper_than_the_recursion_limit():
+    depth = sys.getrecursionlimit() * 2
+    availability = {f"n{i}": 1 for i in range(depth)}
+    children = {f"n{i}": [f"n{i + 1}"] for i in range(depth - 1)}
+    children[f"n{depth - 1}"] = ["n0"]
+
+    graph = make_graph(availability, children)
+    totals = graph.rollup()
+
+    assert totals[graph.find("n0")] == depth
+    assert totals[graph.find(f"n{depth - 1}")] == 1
+
+
+def test_node_key_uses_the_value_of_uuids_and_hashes_other_ids():
+    node_hash = "b9e9c5a5-8c32-3a33-9b4c-4c5a0b3b3c1d"
+
+    assert node_key(node_hash) == int(node_hash.replace("-", ""), 16)
+    assert node_key("root") == node_key("root") != node_key("a")
+    assert node_key("root") < 1 << 128
+
+
+def test_load_maps_a_saved_graph_and_rejects_other_keys(tmp_path):
+    availability = {"root": 1, "a": 2, "b": 3, "ä-node": 4}
+    children = {"root": ["b", "a"], "a": ["ä-node"], "b": ["a"], "ä-node": None}
+    graph = make_graph(availability, children)
+    graph.save(tmp_path / "index.bin", "v1:abc")
+
+    loaded = OntologyGraph.load(tmp_path / "index.bin", "v1:abc")
+
+    assert list(loaded.iter_ids()) == list(graph.iter_ids())
+    assert [loaded.find(h) for h in ("root", "a", "b", "ä-node", "missing")] == [0, 1, 2, 3, None]
+    assert [list(loaded.children(i)) for i in range(len(loaded))] == [[2, 1], [3], [1], []]
+    assert list(loaded.availability) == [0, 0, 0, 0]
+    for node_id, value in availability.items():
+        loaded.availability[loaded.find(node_id)] = value
+    assert loaded.rollup() == graph.rollup()
+
+    assert OntologyGraph.load(tmp_path / "index.bin", "v2:abc") is None
+    assert OntologyGraph.load(tmp_path / "missing.bin", "v1:abc") is None
+    (tmp_path / "broken.bin").write_bytes(b"garbage")
+    assert OntologyGraph.load(tmp_path / "broken.bin", "v1:abc") is None
@@ -0,0 +1,57 @@
+import pstats
+import sys
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
+
+from profiling import StageProfiler
+from run_metrics import RunMetrics
+
+
+@pytest.fixture(autouse=True)
+def stop_tracemalloc():
+    yield
+    tracemalloc.stop()
+
+
+def allocate():
+    return [bytearray(1024) for _ in range(1000)]
+
+
+@pytest.mark.parametrize("mode,files", [
+    ("cpu", ["rollup.pstats"]),
+    ("memory", ["rollup.allocations.txt"]),
+    ("all", ["rollup.allocations.txt", "rollup.pstats"]),
+])
+def test_stages_are_profiled_into_the_profile_dir(tmp_path, mode, files):
+    metrics = RunMetrics(profiler=StageProfiler(tmp_path / "profile", mode))
+
+    with metrics.stage("rollup"):
+        kept = allocate()
+
+    assert sorted(f.name for f in (tmp_path / "profile").iterdir()) == files
+    if mode != "memory":
+        stats = pstats.Stats(str(tmp_path / "profile" / "rollup.pstats"))
+        assert any(function == "allocate" for _, _, function in stats.stats)
+    if mode != "cpu":
+        report = (tmp_path / "profile" / "rollup.allocations.txt").read_text(encoding="utf-8")
+        assert "test_profiling.py" in report.splitlines()[2]
+    assert len(kept) == 1000
+
+
+def test_a_nested_stage_is_part_of_the_outer_profile(tmp_path):
+    metrics = RunMetrics(profiler=StageProfiler(tmp_path / "profile", "all"))
+
+    with metrics.stage("es_upload"):
+        with metrics.stage("rollup"):
+            kept = allocate()
+
+    assert sorted(f.name for f in (tmp_path / "profile").iterdir()) == ["es_upload.allocations.txt",
+                                                                        "es_upload.pstats"]
+    stats = pstats.Stats(str(tmp_path / "profile" / "es_upload.pstats"))
+    assert any(function == "allocate" for _, _, function in stats.stats)
+    assert set(metrics.stages) == {"es_upload", "rollup"}
+    assert len(kept) == 1000
@@ -0,0 +1,41 @@
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src" / "py"))
+
+from run_metrics import RunMetrics
+
+
+def test_stages_are_recorded_in_order_and_summed_up_when_repeated(tmp_path):
+    metrics = RunMetrics()
+
+    with metrics.stage("ontology_load") as stage:
+        stage.count("nodes", 5)
+    for _ in range(2):
+        with metrics.stage("rollup") as stage:
+            stage.count("nodes", 5)
+    metrics.status = "succeeded"
+    metrics.write_summary(tmp_path / "run_summary.json")
+
+    summary = json.loads((tmp_path / "run_summary.json").read_text(encoding="utf-8"))
+    assert summary["status"] == "succeeded"
+    assert [(s["name"], s["items"]) for s in summary["stages"]] == [
+        ("ontology_load", {"nodes": 5}), ("rollup", {"nodes": 10}),
+    ]
+    assert all(s["wall_seconds"] >= 0 and s["peak_rss_bytes"] > 0 for s in summary["stages"])
+
+
+def test_prometheus_text_has_a_sample_per_stage_and_item(tmp_path):
+    metrics = RunMetrics()
+    with metrics.stage("report_download") as stage:
+        stage.count("reports", 3)
+    metrics.status = "failed"
+
+    metrics.write_prometheus(tmp_path / "availability_updater.prom")
+
+    lines = (tmp_path / "availability_updater.prom").read_text(encoding="utf-8").splitlines()
+    assert "# TYPE availability_updater_stage_wall_seconds gauge" in lines
+    assert 'availability_updater_stage_items{stage="report_download",item="reports"} 3' in lines
+    assert "availability_updater_run_success 0" in lines
+    assert any(line.startswith('availability_updater_stage_peak_rss_bytes{stage="report_download"} ') for line in lines)